@@ -6,6 +6,7 @@ from forms import NavTypeForm, ArticleAdminForm  # , NewsletterItemAdminForm, Ne
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 from coop_cms.settings import get_article_class, get_navTree_class
+from coop_cms.tree_renderer import render_jstree
 from sorl.thumbnail.admin import AdminImageMixin
 
 
@@ -27,9 +28,7 @@ class NavTreeAdmin(admin.ModelAdmin):
     list_filters = ['id']
 
     def nodes_li(self, tree):
-        root_nodes = tree.get_root_nodes()
-        nodes_li = u''.join([node.as_jstree() for node in root_nodes])
-        return nodes_li
+        return render_jstree(tree.load_nodes().get_root_nodes())
 
     def navtypes_list(self, tree):
         if tree.types.count() == 0:
@@ -1,5 +1,5 @@
 from django import forms
-from coop_cms.models import NavType, NavNode # Newsletter, NewsletterSending
+from coop_cms.models import NavType, NavNode, navtree_registry # Newsletter, NewsletterSending
 from django.contrib.contenttypes.models import ContentType
 from settings import get_navigable_content_types
 from django.core.exceptions import ValidationError
@@ -9,6 +9,8 @@ import floppyforms
 import re
 from django.conf import settings
 from coop_cms.settings import get_article_class, get_article_templates, get_navTree_class  #,get_newsletter_templates
+from coop_cms.settings import COOP_CMS_NAVIGATION_CACHE_TIMEOUT
+from django.core.cache import cache
 from coop_cms.widgets import ImageEdit
 from django.core.urlresolvers import reverse
 from coop_cms.utils import dehtml
@@ -87,11 +89,20 @@ def get_node_choices():
     #        choices.append((progeny.id, prefix*level+progeny.label))
     #return choices
     choices = [(None, _(u'<not in navigation>'))]
-    for tree in get_navTree_class().objects.all():
+    trees = navtree_registry.get_items().values()
+    for tree in sorted(trees, key=lambda tree: tree.id):
         choices.append((-tree.id, tree.name))
-        for root_node in NavNode.objects.filter(tree=tree, parent__isnull=True).order_by('ordering'):
-            for (progeny, level) in root_node.get_progeny():
-                choices.append((progeny.id, prefix*(level+1)+progeny.label))
+        choices.extend(get_tree_node_choices(tree, prefix))
+    return choices
+
+def get_tree_node_choices(tree, prefix):
+    """choices for the nodes of a tree: built with one query and cached until the tree is modified"""
+    cache_key = u'coop_cms_node_choices_{0}_{1}_{2}'.format(tree.id, tree.get_version(), prefix)
+    choices = cache.get(cache_key) if COOP_CMS_NAVIGATION_CACHE_TIMEOUT else None
+    if choices is None:
+        choices = [(node.id, prefix*(level+1)+node.label) for (node, level) in tree.load_nodes().get_progeny()]
+        if COOP_CMS_NAVIGATION_CACHE_TIMEOUT:
+            cache.set(cache_key, choices, COOP_CMS_NAVIGATION_CACHE_TIMEOUT)
     return choices
 
 def get_navigation_parent_help_text():
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from coop_cms.settings import get_navTree_class
+
+class Command(BaseCommand):
+    args = u'[tree_name tree_name ...]'
+    help = u"create the navigation trees used by the navigation templatetags. 'default' if no name is given"
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity', 1))
+        for name in (args or ['default']):
+            tree, is_new = get_navTree_class().objects.get_or_create(name=name)
+            if verbose:
+                if is_new:
+                    print u"navigation tree '{0}' created".format(name)
+                else:
+                    print u"navigation tree '{0}' already exists".format(name)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils.log import getLogger
+from coop_cms.models import PendingThumbnails, queue_all_thumbnails, generate_object_thumbnails
+
+
+def _generate_thumbnails(item):
+    """generate the thumbnails of an object of the queue: returns the error message if any"""
+    content_type_id, object_id = item
+    try:
+        generate_object_thumbnails(content_type_id, object_id)
+    except Exception, msg:
+        return u'{0} {1}: {2}'.format(content_type_id, object_id, msg)
+    return None
+
+
+class Command(BaseCommand):
+    help = u"generate the thumbnails of the objects saved since the last run (see COOP_CMS_THUMBNAILS_QUEUE)"
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help=u"generate the thumbnails of all the articles, categories and images"),
+        make_option('--processes', type='int', dest='processes', default=cpu_count(),
+            help=u"number of worker processes. 1 generates the thumbnails in the command process"),
+    )
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity', 1))
+        if options['all']:
+            queue_all_thumbnails()
+
+        start = datetime.now()
+        pending = list(PendingThumbnails.objects.values_list('id', 'content_type', 'object_id'))
+        items = [(content_type_id, object_id) for (id, content_type_id, object_id) in pending]
+
+        if options['processes'] > 1 and len(items) > 1:
+            #the workers are forked: they must not share the connection of the command
+            connection.close()
+            pool = Pool(options['processes'])
+            try:
+                errors = pool.map(_generate_thumbnails, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            errors = [_generate_thumbnails(item) for item in items]
+
+        #the failed objects and the objects saved again in the meantime stay in the queue
+        done_ids = [id for ((id, content_type_id, object_id), error) in zip(pending, errors) if not error]
+        PendingThumbnails.objects.filter(id__in=done_ids, queued__lte=start).delete()
+
+        errors = [error for error in errors if error]
+        logger = getLogger('default')
+        for error in errors:
+            logger.error(u"generate_thumbnails failed for {0}".format(error))
+            if verbose:
+                print error
+        if verbose:
+            print len(items) - len(errors), u"objects processed,", len(errors), u"failed and left in the queue"
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from coop_cms.models import NavType, NavLabel, rebuild_navigation_labels
+
+class Command(BaseCommand):
+    help = u"compute again the navigation labels used for searching the objects to add in navigation"
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity', 1))
+        for nav_type in NavType.objects.all():
+            rebuild_navigation_labels(nav_type)
+        if verbose:
+            print NavLabel.objects.count(), u"navigation labels created"
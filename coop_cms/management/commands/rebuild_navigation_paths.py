@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from coop_cms.models import rebuild_navnode_paths
+
+class Command(BaseCommand):
+    help = u"compute again the path of every navigation node"
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity', 1))
+        updated = rebuild_navnode_paths()
+        if verbose:
+            print updated, u"navigation nodes updated"
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from coop_cms.models import rebuild_navnode_urls
+
+class Command(BaseCommand):
+    help = u"compute again the url of every navigation node from its content object"
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity', 1))
+        updated = rebuild_navnode_urls()
+        if verbose:
+            print updated, u"navigation nodes updated"
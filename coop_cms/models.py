@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.db import models, connection, transaction
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
@@ -9,37 +9,51 @@ from django_extensions.db.models import TimeStampedModel, AutoSlugField
 from django.conf import settings
 from sorl.thumbnail import default as sorl_thumbnail
 import os, os.path, shutil
+import threading
 from django.core.urlresolvers import reverse
 from django.db.models.aggregates import Max
+from django.db.models import Q
 from django.utils.html import escape
 from django.core.exceptions import ValidationError
 # from html_field.db.models import HTMLField
 # from html_field import html_cleaner
 from coop_cms.settings import get_article_class, get_article_logo_size  #, get_newsletter_item_classes
-from coop_cms.settings import get_navTree_class, COOP_CMS_NAVTREE_CLASS
+from coop_cms.settings import get_navTree_class, COOP_CMS_NAVTREE_CLASS, COOP_CMS_THUMBNAILS_QUEUE
+from coop_cms.tree_renderer import render_navigation, iter_navigation, render_jstree
 from django.contrib.staticfiles import finders
-from django.core.files import File
-from django.db.models.signals import pre_delete, post_save
+from django.db.models.signals import pre_delete, post_save, post_delete, class_prepared
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.signals import request_started
+from datetime import datetime
 from sorl.thumbnail import ImageField
 from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile as SorlImageFile
 ADMIN_THUMBS_SIZE = '60x60'
+NAVTREE_VERSION_TIMEOUT = 60*60*24*30
+NAVNODE_PATH_MAX_LENGTH = 255
 
 
+def _get_label(nav_type, object):
+    if nav_type and nav_type.label_rule == NavType.LABEL_USE_SEARCH_FIELD:
+        return getattr(object, nav_type.search_field)
+    elif nav_type and nav_type.label_rule == NavType.LABEL_USE_GET_LABEL:
+        return object.get_label()
+    return unicode(object)
+
 def get_object_label(content_type, object):
     """
     returns the label used in navigation according to the configured rule
     """
-    try:
-        nt = NavType.objects.get(content_type=content_type)
-        if nt.label_rule == NavType.LABEL_USE_SEARCH_FIELD:
-            label = getattr(object, nt.search_field)
-        elif nt.label_rule == NavType.LABEL_USE_GET_LABEL:
-            label = object.get_label()
-        else:
-            label = unicode(object)
-    except NavType.DoesNotExist:
-        label = unicode(object)
-    return label
+    return _get_label(navtype_registry.get_navtype(content_type.id), object)
+
+def get_object_labels(content_type, objects):
+    """
+    returns the labels of several objects of the same type without querying the NavType again
+    """
+    nav_type = navtype_registry.get_navtype(content_type.id)
+    return [_get_label(nav_type, object) for object in objects]
 
 def set_node_ordering(node, tree, parent):
     if parent:
@@ -51,6 +65,73 @@ def set_node_ordering(node, tree, parent):
     max_ordering = sibling_nodes.aggregate(max_ordering=Max('ordering'))['max_ordering'] or 0
     node.ordering = max_ordering + 1
 
+_navigation_templates = {}
+
+def get_navigation_template(template):
+    """
+    returns the compiled template used for rendering a node
+    template can be a Template object or a template name. Template names are loaded once per process
+    (unless in DEBUG mode so that changes are taken into account)
+    """
+    if hasattr(template, 'render'):
+        return template
+    if settings.DEBUG:
+        return get_template(template)
+    compiled_template = _navigation_templates.get(template, None)
+    if compiled_template is None:
+        compiled_template = _navigation_templates[template] = get_template(template)
+    return compiled_template
+
+def set_prefetch_group(nodes):
+    """
+    the content objects of the nodes will be fetched at once when one of them is accessed
+    returns the nodes as a list
+    """
+    nodes = list(nodes)
+    for node in nodes:
+        node._prefetch_group = nodes
+    return nodes
+
+def prefetch_content_objects(nodes):
+    """
+    fill the content_object cache of the given nodes
+    the objects are loaded with one query per content type
+    """
+    ids_by_type = {}
+    for node in nodes:
+        if not hasattr(node, '_content_object_cache'):
+            ids_by_type.setdefault(node.content_type_id, set()).add(node.object_id)
+
+    objects_by_type = {}
+    for (ct_id, object_ids) in ids_by_type.items():
+        model_class = ContentType.objects.get_for_id(ct_id).model_class()
+        if model_class:
+            objects_by_type[ct_id] = model_class._default_manager.in_bulk(list(object_ids))
+        else:
+            objects_by_type[ct_id] = {}
+
+    for node in nodes:
+        if not hasattr(node, '_content_object_cache'):
+            node._content_object_cache = objects_by_type[node.content_type_id].get(node.object_id, None)
+    return nodes
+
+def set_navnodes_ordering(node_ids):
+    """give to the nodes their position in the list as ordering with a single UPDATE statement"""
+    if not node_ids:
+        return
+    qn = connection.ops.quote_name
+    sql = u'UPDATE {0} SET {1} = CASE {2} {3} END WHERE {2} IN ({4})'.format(
+        qn(NavNode._meta.db_table), qn('ordering'), qn('id'),
+        u' '.join([u'WHEN %s THEN %s'] * len(node_ids)), u', '.join([u'%s'] * len(node_ids))
+    )
+    params = []
+    for (index, node_id) in enumerate(node_ids):
+        params.extend([node_id, index + 1])
+    params.extend(node_ids)
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+
 def create_navigation_node(content_type, object, tree, parent):
     node = NavNode(tree=tree, label=get_object_label(content_type, object))
     #add it as last child of the selected node
@@ -87,6 +168,166 @@ class NavType(models.Model):
         verbose_name_plural = _(u'navigable types')
 
 
+class Version(models.Model):
+    """
+    Version of some content shared by all the processes: the date of its last change
+    It is kept in the database so that it survives the eviction of the cache
+    """
+    name = models.CharField(max_length=100, unique=True)
+    value = models.CharField(max_length=30)
+
+    def __unicode__(self):
+        return self.name
+
+
+#The versions are kept in the cache when it is shared by the processes (memcached, database...)
+#With a process-local cache (local memory or dummy), a process doesn't see the changes made by the others:
+#the versions are then read from the database once per request
+VERSIONS_IN_CACHE = not isinstance(cache, (LocMemCache, DummyCache))
+_request_versions = threading.local()
+
+def _get_request_versions():
+    if not hasattr(_request_versions, 'values'):
+        _request_versions.values = {}
+    return _request_versions.values
+
+def on_request_started(sender, **kwargs):
+    _request_versions.values = {}
+request_started.connect(on_request_started)
+
+def get_stored_version(key, read_version):
+    """returns the version stored under key: read_version reads it from the database if needed"""
+    versions = None if VERSIONS_IN_CACHE else _get_request_versions()
+    version = cache.get(key) if VERSIONS_IN_CACHE else versions.get(key, None)
+    if version is None:
+        version = read_version()
+        set_stored_version(key, version)
+    return version
+
+def set_stored_version(key, version):
+    if VERSIONS_IN_CACHE:
+        cache.set(key, version, NAVTREE_VERSION_TIMEOUT)
+    else:
+        _get_request_versions()[key] = version
+
+def get_version_key(name):
+    return 'coop_cms_version_{0}'.format(name)
+
+def get_version(name):
+    """returns the version of the content called name"""
+    def read_version():
+        values = Version.objects.filter(name=name).values_list('value', flat=True)
+        return values[0] if values else update_version(name)
+    return get_stored_version(get_version_key(name), read_version)
+
+def update_version(name):
+    """the content called name has changed: returns its new version"""
+    value = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    if not Version.objects.filter(name=name).update(value=value):
+        Version.objects.create(name=name, value=value)
+    set_stored_version(get_version_key(name), value)
+    return value
+
+
+class CachedRegistry(object):
+    """
+    Process-local cache of some database objects
+    A shared version (see get_version) is changed when the objects are modified
+    so that every process reloads them
+    """
+    version_name = ''
+
+    def __init__(self):
+        self._items = {}
+        self._version = None
+
+    def load(self):
+        raise NotImplementedError
+
+    def get_items(self):
+        version = get_version(self.version_name)
+        if version != self._version:
+            self._items = self.load()
+            self._version = version
+        return self._items
+
+    def invalidate(self):
+        return update_version(self.version_name)
+
+
+class NavTypeRegistry(CachedRegistry):
+    """
+    Process-local cache of the NavTypes by content type id
+    The content types which have nodes without being a NavType are also registered (with None)
+    """
+    version_name = 'navtype_registry'
+
+    def load(self):
+        items = dict([(ct_id, None) for ct_id in NavNode.objects.values_list('content_type', flat=True).distinct()])
+        items.update(dict([(nt.content_type_id, nt) for nt in NavType.objects.all()]))
+        return items
+
+    def get_navtype(self, content_type_id):
+        return self.get_items().get(content_type_id, None)
+
+    def is_navigable(self, content_type_id):
+        return content_type_id in self.get_items()
+
+navtype_registry = NavTypeRegistry()
+
+
+class NavLabel(models.Model):
+    """
+    Navigation label of an object which NavType doesn't use a search field
+    Used for searching the objects which can be added to a navigation tree
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    label = models.CharField(max_length=200, db_index=True)
+
+    def __unicode__(self):
+        return self.label
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+
+def uses_navigation_label(nav_type):
+    return bool(nav_type) and nav_type.label_rule != NavType.LABEL_USE_SEARCH_FIELD
+
+def rebuild_navigation_labels(nav_type):
+    """rebuild the navigation labels of all the objects of the type"""
+    ct = nav_type.content_type
+    NavLabel.objects.filter(content_type=ct).delete()
+    if uses_navigation_label(nav_type):
+        NavLabel.objects.bulk_create([
+            NavLabel(content_type=ct, object_id=obj.id, label=_get_label(nav_type, obj)[:200])
+            for obj in ct.model_class().objects.all()
+        ])
+
+
+class NavNodeContentObject(generic.GenericForeignKey):
+    """
+    content object of a node
+    When the node has been loaded with other nodes (a tree, a breadcrumb...), the content objects
+    of all these nodes are fetched at once the first time one of them is accessed
+    """
+
+    def __get__(self, instance, instance_type=None):
+        if instance is not None and not hasattr(instance, self.cache_attr):
+            prefetch_group = getattr(instance, '_prefetch_group', None)
+            if prefetch_group:
+                prefetch_content_objects(prefetch_group)
+        return super(NavNodeContentObject, self).__get__(instance, instance_type)
+
+
+class NavNodeManager(models.Manager):
+
+    def with_content_objects(self):
+        """the content objects of the nodes are loaded with one query per content type"""
+        return self.get_query_set().prefetch_related('content_object')
+
+
 class NavNode(models.Model):
     """
     A navigation node
@@ -102,10 +343,23 @@ class NavNode(models.Model):
     #generic relation
     content_type = models.ForeignKey(ContentType, verbose_name=_("content_type"))
     object_id = models.PositiveIntegerField(verbose_name=_("object id"))
-    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    content_object = NavNodeContentObject('content_type', 'object_id')
+
     in_navigation = models.BooleanField(_("in navigation"), default=True)
+    #materialized path: ids of the ancestors separated by slashes. '/' for a root node
+    #'' if unknown or too long for the column: the parents are walked
+    path = models.CharField(_("path"), max_length=NAVNODE_PATH_MAX_LENGTH, db_index=True, blank=True, default='', editable=False)
+    #url of the content object: refreshed when the object is saved
+    url = models.TextField(_("url"), blank=True, default='', editable=False)
+
+    objects = NavNodeManager()
 
     def get_absolute_url(self):
+        if self.url:
+            return self.url
+        return self._get_content_url()
+
+    def _get_content_url(self):
         if self.content_object:
             return self.content_object.get_absolute_url()
         return ""
@@ -119,93 +373,169 @@ class NavNode(models.Model):
     class Meta:
         verbose_name = _(u'navigation node')
         verbose_name_plural = _(u'navigation nodes')
+        #an index on (tree, content_type, object_id) is created by the migration 0033
         #unique_together = ('content_type', 'object_id')
 
+    def save(self, *args, **kwargs):
+        old_children_path = self.get_children_path() if self.id else None
+        self.path = self._get_path()
+        if not self.url:
+            self.url = self._get_content_url()
+        ret = super(NavNode, self).save(*args, **kwargs)
+        new_children_path = self.get_children_path()
+        if old_children_path is not None and (old_children_path or new_children_path) \
+            and old_children_path != new_children_path:
+            self._update_progeny_path()
+        return ret
+
+    def _get_path(self):
+        if self.parent_id:
+            parent_path = self.parent.path
+            return fit_navnode_path(self.parent.get_children_path()) if parent_path else u''
+        return u'/'
+
+    def _update_progeny_path(self):
+        #the node has moved: compute again the path of all its progeny from the parent relationship
+        #the paths which were unknown (too long) may be known again: one UPDATE for the children of each node
+        children_paths = {self.id: self.get_children_path()}
+        while children_paths:
+            nodes = list(NavNode.objects.filter(parent__in=children_paths.keys()).values_list('id', 'parent'))
+            for parent_id in set([parent_id for (node_id, parent_id) in nodes]):
+                NavNode.objects.filter(parent=parent_id).update(path=children_paths[parent_id])
+            children_paths = dict([
+                (node_id, fit_navnode_path(u'{0}{1}/'.format(children_paths[parent_id], node_id))
+                    if children_paths[parent_id] else u'')
+                for (node_id, parent_id) in nodes
+            ])
+
+    def get_children_path(self):
+        """the path of the children of this node"""
+        return u'{0}{1}/'.format(self.path, self.id) if self.path else u''
+
+    def get_ancestor_ids(self):
+        return [int(x) for x in self.path.split('/') if x]
+
+    def get_ancestors(self):
+        """returns the ancestors of the node, starting from the root node"""
+        if self.path and not getattr(self, '_tree_nodes', None):
+            ancestor_ids = self.get_ancestor_ids()
+            nodes = NavNode.objects.in_bulk(ancestor_ids)
+            return [nodes[x] for x in ancestor_ids if x in nodes]
+        ancestors = []
+        node = self.parent
+        while node:
+            ancestors.insert(0, node)
+            node = node.parent
+        return ancestors
+
+    def get_breadcrumb(self):
+        """
+        returns the ancestors of the node and the node itself
+        in one query at most and without any query if the tree is loaded
+        """
+        return set_prefetch_group(self.get_ancestors() + [self])
+
+    def get_depth(self):
+        if self.path:
+            return self.path.count('/') - 1
+        return len(self.get_ancestors())
+
     def get_children(self, in_navigation=None):
+        tree_nodes = getattr(self, '_tree_nodes', None)
+        if tree_nodes:
+            return tree_nodes.get_children(self, in_navigation)
         nodes = NavNode.objects.filter(parent=self).order_by("ordering")
         if in_navigation != None:
             nodes = nodes.filter(in_navigation=in_navigation)
         return nodes
 
     def has_children(self):
+        if getattr(self, '_tree_nodes', None):
+            return len(self.get_children(True))
         return self.get_children(True).count()
 
     def get_siblings(self, in_navigation=None):
-        nodes = NavNode.objects.filter(parent=self.parent).order_by("ordering")
+        nodes = NavNode.objects.filter(parent=self.parent_id).order_by("ordering")
         if in_navigation != None:
             nodes = nodes.filter(in_navigation=in_navigation)
         return nodes
 
     def get_progeny(self, level=0):
+        children = {}
+        if self.path:
+            #all the progeny is loaded with one query and sorted in memory
+            for node in NavNode.objects.filter(path__startswith=self.get_children_path()).order_by("ordering"):
+                children.setdefault(node.parent_id, []).append(node)
         progeny = []
-        progeny.append((self, level))
-        for child in NavNode.objects.filter(parent=self).order_by("ordering"):
-            progeny.extend(child.get_progeny(level+1))
+        stack = [(self, level)]
+        while stack:
+            node, node_level = stack.pop()
+            progeny.append((node, node_level))
+            if fit_navnode_path(node.get_children_path()):
+                node_children = children.get(node.id, [])
+            else:
+                #the path of the children is unknown: one query per node
+                node_children = NavNode.objects.filter(parent=node).order_by("ordering")
+            stack.extend(reversed([(child, node_level+1) for child in node_children]))
         return progeny
 
     def as_jstree(self):
-        li_content = u'<a href="{0}">{1}</a>'.format(self.get_absolute_url(), self.label)
+        return render_jstree([self])
 
-        children_li = [child.as_jstree() for child in self.get_children()]
-
-        return u'<li id="node_{0}" rel={3}>{1}<ul>{2}</ul></li>'.format(
-            self.id, li_content, u''.join(children_li), "in_nav" if self.in_navigation else "out_nav"
-        )
+    def _render_template(self, template, context):
+        context.push()
+        try:
+            context['node'] = self
+            return get_navigation_template(template).render(context)
+        finally:
+            context.pop()
 
-    def _get_li_content(self, li_template):
+    def _get_li_content(self, li_template, context=None):
         if li_template:
-            t = li_template if hasattr(li_template, 'render') else get_template(li_template)
-            return t.render(Context({'node': self}))
+            return self._render_template(li_template, context or Context())
         else:
             return u'<a href="{0}">{1}</a>'.format(self.get_absolute_url(), self.label)
 
-    def _get_ul_format(self, ul_template):
+    def _get_ul_format(self, ul_template, context=None):
         if ul_template:
-            t = ul_template if hasattr(ul_template, 'render') else get_template(ul_template)
-            return t.render(Context({'node': self}))
+            return self._render_template(ul_template, context or Context())
         else:
             return u'<ul>{0}</ul>'
 
-    def _get_li_args(self, li_args):
+    def _get_li_args(self, li_args, context=None):
         if li_args:
-            t = li_args if hasattr(li_args, 'render') else get_template(li_args)
-            return t.render(Context({'node': self}))
+            return self._render_template(li_args, context or Context())
         else:
             return u''
 
     def as_navigation(self, li_template=None, css_class="", ul_template=None, li_args=None):
         #Display the node and his children as nested ul and li html tags.
         #li_template is a custom template that can be passed
-
-        if not self.in_navigation:
-            return ""
-
-        children_li = [child.as_navigation(li_template) for child in self.get_children(in_navigation=True)]
-        ul_format = self._get_ul_format(ul_template)
-        children_html = ul_format.format(u''.join(children_li)) if children_li else ""
-        args = self._get_li_args(li_args)
-        if args:
-            css_class = " "+args
-        return u'<li{0}>{1}{2}</li>'.format(css_class, self._get_li_content(li_template), children_html)
+        return render_navigation([self], li_template=li_template, css_class=css_class,
+            ul_template=ul_template, li_args=li_args)
 
     def as_breadcrumb(self, init, li_template=None, self_hide=False):
-        html = self.parent.as_breadcrumb(init, li_template, self_hide) if self.parent else u""
-        if self == init and self_hide:
-            return html
-        else:
-            if init.parent == self and self_hide:
-                return html + u'<li><a href="{0}">{1}</a></li>'.format(self.get_absolute_url(), self.label)
+        html = u""
+        context = Context()
+        for node in self.get_breadcrumb():
+            if node == init and self_hide:
+                continue
+            if init.parent_id == node.id and self_hide:
+                html += u'<li><a href="{0}">{1}</a></li>'.format(node.get_absolute_url(), node.label)
             else:
-                return html + u'<li>{0}</li>'.format(self._get_li_content(li_template))
+                html += u'<li>{0}</li>'.format(node._get_li_content(li_template, context))
+        return html
 
     def children_as_navigation(self, li_template=None, css_class=""):
-        children_li = [u'<li{0}>{1}</li>'.format(css_class, child._get_li_content(li_template))
-            for child in self.get_children(in_navigation=True)]
+        context = Context()
+        children_li = [u'<li{0}>{1}</li>'.format(css_class, child._get_li_content(li_template, context))
+            for child in set_prefetch_group(self.get_children(in_navigation=True))]
         return  u''.join(children_li)
 
     def siblings_as_navigation(self, li_template=None, css_class=""):
-        siblings_li = [u'<li{0}>{1}</li>'.format(css_class, sibling._get_li_content(li_template))
-            for sibling in self.get_siblings(in_navigation=True)]
+        context = Context()
+        siblings_li = [u'<li{0}>{1}</li>'.format(css_class, sibling._get_li_content(li_template, context))
+            for sibling in set_prefetch_group(self.get_siblings(in_navigation=True))]
         return  u''.join(siblings_li)
 
     def check_new_navigation_parent(self, parent_id):
@@ -213,11 +543,193 @@ class NavNode(models.Model):
             raise ValidationError(_(u'A node can not be its own parent'))
 
         if parent_id:
-            cur_node = NavNode.objects.get(id=parent_id)
-            while cur_node:
-                if cur_node.id == self.id:
+            tree_nodes = getattr(self, '_tree_nodes', None)
+            parent = tree_nodes.get_node(parent_id) if tree_nodes else None
+            self.check_new_parent(parent or NavNode.objects.get(id=parent_id))
+
+    def check_new_parent(self, parent):
+        """raise a ValidationError if the node can not be moved under parent: without query once parent is loaded"""
+        if not parent:
+            return
+        if parent.id == self.id:
+            raise ValidationError(_(u'A node can not be its own parent'))
+        if parent.path and not getattr(parent, '_tree_nodes', None):
+            if self.id in parent.get_ancestor_ids():
+                raise ValidationError(_(u'A node can not be child of its own child'))
+            return
+        #the parents are in memory if the tree is loaded
+        cur_node = parent
+        while cur_node:
+            if cur_node.id == self.id:
+                raise ValidationError(_(u'A node can not be child of its own child'))
+            cur_node = cur_node.parent
+
+
+def fit_navnode_path(path):
+    """returns the path or '' (unknown path) if it is too long for the column"""
+    return path if len(path) <= NAVNODE_PATH_MAX_LENGTH else u''
+
+def get_navtree_version_key(tree_id):
+    return 'coop_cms_navtree_version_{0}'.format(tree_id)
+
+def update_navtree_version(tree_id):
+    """
+    a node of the tree has changed: touch the last_update of the tree
+    the new version is shared by all processes through the database (see get_stored_version)
+    """
+    now = datetime.now()
+    get_navTree_class().objects.filter(id=tree_id).update(last_update=now)
+    set_stored_version(get_navtree_version_key(tree_id), now.strftime('%Y%m%d%H%M%S%f'))
+
+def rebuild_navnode_urls():
+    """
+    compute the url of every node from its content object
+    returns the number of updated nodes
+    """
+    updated = 0
+    for node in NavNode.objects.with_content_objects():
+        url = node._get_content_url()
+        if url != node.url:
+            NavNode.objects.filter(id=node.id).update(url=url)
+            updated += 1
+    for tree in get_navTree_class().objects.all():
+        update_navtree_version(tree.id)
+    return updated
+
+def rebuild_navnode_paths():
+    """
+    compute the path of every node from the parent relationship
+    returns the number of updated nodes
+    """
+    children = {}
+    for (node_id, parent_id, path) in NavNode.objects.values_list('id', 'parent', 'path'):
+        children.setdefault(parent_id or None, []).append((node_id, path))
+
+    updated = 0
+    stack = [(node_id, old_path, u'/') for (node_id, old_path) in children.get(None, [])]
+    while stack:
+        node_id, old_path, path = stack.pop()
+        if old_path != path:
+            NavNode.objects.filter(id=node_id).update(path=path)
+            updated += 1
+        children_path = fit_navnode_path(u'{0}{1}/'.format(path, node_id)) if path else u''
+        stack.extend([(child_id, child_path, children_path) for (child_id, child_path) in children.get(node_id, [])])
+    return updated
+
+
+class NavTreeNodes(object):
+    """
+    All the nodes of a tree loaded with a single query
+    The content objects are loaded with one query per content type
+    and the nodes are indexed by parent so that the tree can be rendered without any other query
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self._nodes = {}
+        self._children = {}
+        #children are attached by parent even if they belong to another tree
+        nodes = list(NavNode.objects.filter(Q(tree=tree) | Q(parent__tree=tree)).order_by("ordering"))
+        foreign_ids = [n.id for n in nodes if n.tree_id != tree.id]
+        while foreign_ids:
+            loaded_ids = [n.id for n in nodes]
+            foreign_children = list(NavNode.objects.filter(parent__id__in=foreign_ids).exclude(id__in=loaded_ids))
+            nodes.extend(foreign_children)
+            foreign_ids = [n.id for n in foreign_children]
+        nodes.sort(key=lambda n: n.ordering)
+        for node in nodes:
+            self._nodes[node.id] = node
+        #like with parent__isnull, a node which parent doesn't exist (eg: parent_id=0) is a root node
+        missing_parent_ids = set([n.parent_id for n in nodes if n.parent_id and n.parent_id not in self._nodes])
+        if missing_parent_ids:
+            missing_parent_ids -= set(NavNode.objects.filter(id__in=missing_parent_ids).values_list('id', flat=True))
+        set_prefetch_group(nodes)
+        for node in nodes:
+            node._tree_nodes = self
+            parent_id = None if (node.parent_id in missing_parent_ids or not node.parent_id) else node.parent_id
+            if parent_id is None or parent_id in self._nodes:
+                node._parent_cache = self._nodes.get(parent_id, None)
+            self._children.setdefault(parent_id, []).append(node)
+
+    def get_node(self, node_id):
+        return self._nodes.get(node_id, None)
+
+    def get_root_nodes(self):
+        return self._children.get(None, [])
+
+    def get_children(self, node, in_navigation=None):
+        nodes = self._children.get(node.id, [])
+        if in_navigation != None:
+            nodes = [n for n in nodes if n.in_navigation == in_navigation]
+        return nodes
+
+    def get_progeny(self):
+        """returns all the nodes of the tree in display order with their level"""
+        progeny = []
+        stack = [(node, 0) for node in reversed(self.get_root_nodes())]
+        while stack:
+            node, level = stack.pop()
+            progeny.append((node, level))
+            stack.extend(reversed([(child, level+1) for child in self.get_children(node)]))
+        return progeny
+
+    def check_moves(self, moves):
+        """
+        check a list of (node_id, new_parent_id) moves as a whole, without any query
+        raise a ValidationError if a node is unknown or if the moves would create a cycle
+        """
+        parents = dict([(node_id, node.parent_id) for (node_id, node) in self._nodes.items()])
+        for (node_id, parent_id) in moves:
+            if node_id not in parents or (parent_id and parent_id not in parents):
+                raise ValidationError(_(u'Unknown node'))
+            parents[node_id] = parent_id or None
+
+        for (node_id, parent_id) in moves:
+            visited = set([node_id])
+            cur_id = parents[node_id]
+            while cur_id:
+                if cur_id in visited:
                     raise ValidationError(_(u'A node can not be child of its own child'))
-                cur_node = cur_node.parent
+                visited.add(cur_id)
+                cur_id = parents.get(cur_id, None)
+
+    def as_navigation(self, **kwargs):
+        return render_navigation(self.get_root_nodes(), **kwargs)
+
+    def iter_navigation(self, **kwargs):
+        """yields the html of the navigation by chunks: see tree_renderer.iter_navigation"""
+        return iter_navigation(self.get_root_nodes(), **kwargs)
+
+
+_NAVNODE_INDEX_FIELDS = ('id', 'tree', 'label', 'parent', 'ordering', 'content_type', 'object_id',
+    'in_navigation', 'path', 'url')
+
+class NavNodeIndex(object):
+    """
+    Process-local index of the nodes of a tree by content object
+    It is built with one query and kept until the version of the tree changes
+    """
+    _indexes = {}
+
+    def __init__(self, tree):
+        self._nodes = {}
+        attnames = [NavNode._meta.get_field(f).attname for f in _NAVNODE_INDEX_FIELDS]
+        for values in NavNode.objects.filter(tree=tree).order_by('id').values_list(*_NAVNODE_INDEX_FIELDS):
+            node_values = dict(zip(attnames, values))
+            self._nodes.setdefault((node_values['content_type_id'], node_values['object_id']), node_values)
+
+    @classmethod
+    def get(cls, tree):
+        version = tree.get_version()
+        index = cls._indexes.get(tree.id, None)
+        if not index or index[0] != version:
+            index = cls._indexes[tree.id] = (version, cls(tree))
+        return index[1]
+
+    def get_node(self, content_type_id, object_id):
+        """returns a new NavNode for the object or None if it is not in the tree"""
+        values = self._nodes.get((content_type_id, object_id), None)
+        return NavNode(**values) if values else None
 
 
 class BaseNavTree(models.Model):
@@ -232,13 +744,58 @@ class BaseNavTree(models.Model):
         return reverse('navigation_tree', args=[self.id])
 
     def get_root_nodes(self):
-        return NavNode.objects.filter(tree=self, parent__isnull=True).order_by("ordering")
+        """the content objects of the root nodes are fetched at once when one of them is accessed"""
+        return set_prefetch_group(NavNode.objects.filter(tree=self, parent__isnull=True).order_by("ordering"))
+
+    def get_node_by_object(self, content_type_id, object_id):
+        """returns the node of the object in this tree without any query once the tree is indexed"""
+        return NavNodeIndex.get(self).get_node(content_type_id, object_id)
+
+    def load_nodes(self):
+        """returns all the nodes of the tree indexed by parent: see NavTreeNodes"""
+        return NavTreeNodes(self)
+
+    def get_version(self):
+        """returns a version string which changes every time a node of the tree is modified"""
+        def read_version():
+            #the tree may come from the registry: read the last_update from the database
+            last_update = get_navTree_class().objects.filter(id=self.id).values_list('last_update', flat=True)
+            return (last_update[0] if last_update else self.last_update).strftime('%Y%m%d%H%M%S%f')
+        return get_stored_version(get_navtree_version_key(self.id), read_version)
+
+    def save(self, *args, **kwargs):
+        ret = super(BaseNavTree, self).save(*args, **kwargs)
+        set_stored_version(get_navtree_version_key(self.id), self.last_update.strftime('%Y%m%d%H%M%S%f'))
+        return ret
 
     class Meta:
         verbose_name = _(u'Navigation tree')
         verbose_name_plural = _(u'Navigation trees')
         abstract = True
 
+class NavTreeRegistry(CachedRegistry):
+    """Process-local cache of the navigation trees by name"""
+    version_name = 'navtree_registry'
+
+    def load(self):
+        return dict([(tree.name, tree) for tree in get_navTree_class().objects.all()])
+
+    def get_tree(self, name):
+        """returns the tree with the given name or None if it doesn't exist"""
+        return self.get_items().get(name, None)
+
+navtree_registry = NavTreeRegistry()
+
+def on_navtree_changed(sender, instance, **kwargs):
+    navtree_registry.invalidate()
+
+def connect_navtree_signals(sender, **kwargs):
+    #the concrete NavTree class is defined by the project: connect the signals when it is created
+    if issubclass(sender, BaseNavTree) and not sender._meta.abstract:
+        post_save.connect(on_navtree_changed, sender=sender)
+        post_delete.connect(on_navtree_changed, sender=sender)
+class_prepared.connect(connect_navtree_signals)
+
 #content_cleaner = html_cleaner.HTMLCleaner(
 #    allow_tags=['a', 'img', 'p', 'br', 'b', 'i', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
 #        'sup', 'pre', 'ul', 'li', 'ol', 'table', 'th', 'tr', 'td', 'tbody', 'span', 'div',
@@ -278,6 +835,44 @@ class ArticleCategory(models.Model):
     logo_list_display.short_description = _(u"logo")
     logo_list_display.allow_tags = True
 
+    def generate_thumbnails(self):
+        """generate the thumbnails of the logo in the sizes used by the site"""
+        self.logo_list_display()
+
+
+DEFAULT_LOGO = 'img/default-logo.png'
+#the static file of the default logo, its modification time and its thumbnails by size
+_default_logo = {'static_filename': None, 'mtime': None, 'thumbnails': {}}
+
+def get_default_logo_thumbnail(size):
+    """
+    returns the thumbnail of the default logo for articles without logo
+    It is computed once per size and per process, and again when the static file changes
+    """
+    if not _default_logo['static_filename']:
+        _default_logo['static_filename'] = finders.find(DEFAULT_LOGO)
+    static_filename = _default_logo['static_filename']
+    mtime = os.path.getmtime(static_filename)
+    if mtime != _default_logo['mtime']:
+        #copy from static to media in order to use sorl thumbnail without raising a suspicious operation
+        media_filename = os.path.normpath(settings.MEDIA_ROOT + '/coop_cms/' + DEFAULT_LOGO)
+        if not os.path.exists(media_filename) or os.path.getmtime(media_filename) != mtime:
+            dir = os.path.dirname(media_filename)
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+            shutil.copy2(static_filename, media_filename)
+            #the thumbnails of the previous logo must not be used anymore
+            sorl_thumbnail.kvstore.delete(SorlImageFile(media_filename))
+        _default_logo.update(mtime=mtime, media_filename=media_filename, thumbnails={})
+
+    thumbnails = _default_logo['thumbnails']
+    if size not in thumbnails:
+        #sorl only needs the name of the file: the file is not opened
+        thumbnails[size] = sorl_thumbnail.backend.get_thumbnail(
+            _default_logo['media_filename'], size, crop='center'
+        )
+    return thumbnails[size]
+
 
 class BaseArticle(TimeStampedModel):
     """An article : static page, blog item, ..."""
@@ -316,22 +911,8 @@ class BaseArticle(TimeStampedModel):
         logo = self.temp_logo if (temp and self.temp_logo) else self.logo
         size = logo_size or get_article_logo_size(self)
         if logo:
-            file = logo.file
-        else:
-            file = self._get_default_logo()
-        return sorl_thumbnail.backend.get_thumbnail(file, size, crop='center')
-
-    def _get_default_logo(self):
-        #copy from static to media in order to use sorl thumbnail without raising a suspicious operation
-        filename = 'img/default-logo.png'
-        media_filename = os.path.normpath(settings.MEDIA_ROOT + '/coop_cms/' + filename)
-        if not os.path.exists(media_filename):
-            dir = os.path.dirname(media_filename)
-            if not os.path.exists(dir):
-                os.makedirs(dir)
-            static_filename = finders.find(filename)
-            shutil.copyfile(static_filename, media_filename)
-        return File(open(media_filename, 'r'))
+            return sorl_thumbnail.backend.get_thumbnail(logo.file, size, crop='center')
+        return get_default_logo_thumbnail(size)
 
     def logo_list_display(self):
         if self.logo:
@@ -342,6 +923,11 @@ class BaseArticle(TimeStampedModel):
     logo_list_display.short_description = _(u"logo")
     logo_list_display.allow_tags = True
 
+    def generate_thumbnails(self):
+        """generate the thumbnails of the logo in the sizes used by the site"""
+        self.logo_thumbnail()
+        self.logo_list_display()
+
     class Meta:
         verbose_name = _(u"article")
         verbose_name_plural = _(u"articles")
@@ -461,6 +1047,10 @@ class Image(Media):
     def as_thumbnail(self):
         return sorl_thumbnail.backend.get_thumbnail(self.file.file, "64x64", crop='center')
 
+    def generate_thumbnails(self):
+        """generate the thumbnails in the sizes used by the site"""
+        self.as_thumbnail()
+
     def get_absolute_url(self):
         return self.file.url
 
@@ -530,17 +1120,178 @@ class PieceOfHtml(models.Model):
         verbose_name = _(u'piece of HTML')
         verbose_name_plural = _(u'pieces of HTML')
 
+#the nodes are removed at once by remove_from_navigation_bulk: skip the per-object hooks
+#only for the models being removed, not for the objects of other models deleted in cascade
+_bulk_removal = threading.local()
+
+def _is_bulk_removed(sender):
+    return sender in getattr(_bulk_removal, 'models', ())
+
 #delete node when content object is deleted
 def remove_from_navigation(sender, instance, **kwargs):
-    if hasattr(instance, 'id'):
-        try:
-            ct = ContentType.objects.get_for_model(instance)
-            node = NavNode.objects.get(content_type=ct, object_id=instance.id)
-            node.delete()
-        except (NavNode.DoesNotExist, ContentType.DoesNotExist):
-            pass
+    #only the models with get_absolute_url can be in navigation: don't query anything for the others
+    if not hasattr(sender, 'get_absolute_url') or _is_bulk_removed(sender):
+        return
+    if getattr(instance, 'id', None) is not None:
+        ct = ContentType.objects.get_for_model(instance)
+        if navtype_registry.is_navigable(ct.id):
+            NavNode.objects.filter(content_type=ct, object_id=instance.id).delete()
 pre_delete.connect(remove_from_navigation)
 
+def remove_from_navigation_bulk(queryset):
+    """remove the nodes of all the objects of the queryset with a single query"""
+    ct = ContentType.objects.get_for_model(queryset.model)
+    nodes = NavNode.objects.filter(content_type=ct, object_id__in=queryset.values('pk'))
+    tree_ids = set(nodes.values_list('tree', flat=True))
+    _bulk_removal.models = (NavNode,)
+    try:
+        nodes.delete()
+        NavLabel.objects.filter(content_type=ct, object_id__in=queryset.values('pk')).delete()
+    finally:
+        _bulk_removal.models = ()
+    for tree_id in tree_ids:
+        update_navtree_version(tree_id)
+
+def delete_navigable_objects(queryset):
+    """delete the objects of the queryset and their navigation nodes without a query per object"""
+    remove_from_navigation_bulk(queryset)
+    _bulk_removal.models = (queryset.model,)
+    try:
+        queryset.delete()
+    finally:
+        _bulk_removal.models = ()
+
+#keep the url of the nodes up to date
+def update_navnode_urls(sender, instance, **kwargs):
+    if not hasattr(sender, 'get_absolute_url') or sender is NavNode:
+        return
+    ct = ContentType.objects.get_for_model(instance)
+    if navtype_registry.is_navigable(ct.id):
+        url = instance.get_absolute_url()
+        nodes = NavNode.objects.filter(content_type=ct, object_id=instance.id).exclude(url=url)
+        tree_ids = set(nodes.values_list('tree', flat=True))
+        if tree_ids:
+            nodes.update(url=url)
+            for tree_id in tree_ids:
+                update_navtree_version(tree_id)
+post_save.connect(update_navnode_urls)
+
+def on_navtype_changed(sender, instance, **kwargs):
+    navtype_registry.invalidate()
+post_save.connect(on_navtype_changed, sender=NavType)
+post_delete.connect(on_navtype_changed, sender=NavType)
+
+def on_navtype_saved(sender, instance, **kwargs):
+    rebuild_navigation_labels(instance)
+post_save.connect(on_navtype_saved, sender=NavType)
+
+def on_navtype_deleted(sender, instance, **kwargs):
+    NavLabel.objects.filter(content_type=instance.content_type_id).delete()
+post_delete.connect(on_navtype_deleted, sender=NavType)
+
+#keep the navigation label of the object up to date
+def update_navigation_label(sender, instance, **kwargs):
+    if not hasattr(sender, 'get_absolute_url'):
+        return
+    ct = ContentType.objects.get_for_model(instance)
+    nav_type = navtype_registry.get_navtype(ct.id)
+    if uses_navigation_label(nav_type):
+        label = _get_label(nav_type, instance)[:200]
+        if not NavLabel.objects.filter(content_type=ct, object_id=instance.id).update(label=label):
+            NavLabel.objects.create(content_type=ct, object_id=instance.id, label=label)
+post_save.connect(update_navigation_label)
+
+def remove_navigation_label(sender, instance, **kwargs):
+    if not hasattr(sender, 'get_absolute_url') or _is_bulk_removed(sender):
+        return
+    ct = ContentType.objects.get_for_model(instance)
+    if uses_navigation_label(navtype_registry.get_navtype(ct.id)):
+        NavLabel.objects.filter(content_type=ct, object_id=instance.id).delete()
+post_delete.connect(remove_navigation_label)
+
+#invalidate the rendering cache of the tree when one of its nodes is changed
+def on_navnode_changed(sender, instance, **kwargs):
+    if _is_bulk_removed(sender):
+        return
+    update_navtree_version(instance.tree_id)
+    if not navtype_registry.is_navigable(instance.content_type_id):
+        navtype_registry.invalidate()
+post_save.connect(on_navnode_changed, sender=NavNode)
+post_delete.connect(on_navnode_changed, sender=NavNode)
+
+#version of the content shared by the pages: categories and pieces of html
+#kept in the database (see get_version): the pages validators survive the eviction of the cache
+def get_pages_version():
+    return get_version('pages')
+
+def update_pages_version():
+    return update_version('pages')
+
+def on_page_content_changed(sender, instance, **kwargs):
+    update_pages_version()
+for model_class in (ArticleCategory, PieceOfHtml):
+    post_save.connect(on_page_content_changed, sender=model_class)
+    post_delete.connect(on_page_content_changed, sender=model_class)
+
+#version of the articles: changes when an article is saved or deleted
+#used by the pages listing articles which can't detect that an article has been removed from the list
+def get_articles_version():
+    return get_version('articles')
+
+def update_articles_version():
+    return update_version('articles')
+
+def on_article_changed(sender, instance, **kwargs):
+    #the article class is defined by the project: the signals can't be connected to a sender
+    if isinstance(instance, BaseArticle):
+        update_articles_version()
+post_save.connect(on_article_changed)
+post_delete.connect(on_article_changed)
+
+
+class PendingThumbnails(models.Model):
+    """
+    An object which thumbnails must be generated in the background
+    The queue is processed by the generate_thumbnails command
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    queued = models.DateTimeField(default=datetime.now)
+
+    def __unicode__(self):
+        return u'{0} {1}'.format(self.content_type, self.object_id)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+def queue_thumbnails(instance):
+    """add the object to the queue of the thumbnails to generate"""
+    ct = ContentType.objects.get_for_model(instance)
+    #an object saved again while being processed must stay in the queue
+    if not PendingThumbnails.objects.filter(content_type=ct, object_id=instance.id).update(queued=datetime.now()):
+        PendingThumbnails.objects.create(content_type=ct, object_id=instance.id)
+
+def queue_all_thumbnails():
+    """add all the articles, categories and images to the queue of the thumbnails to generate"""
+    for model_class in (get_article_class(), ArticleCategory, Image):
+        for instance in model_class.objects.all():
+            queue_thumbnails(instance)
+
+def generate_object_thumbnails(content_type_id, object_id):
+    """generate the thumbnails of the object. Returns False if it doesn't exist anymore"""
+    ct = ContentType.objects.get_for_id(content_type_id)
+    try:
+        instance = ct.get_object_for_this_type(id=object_id)
+    except ct.model_class().DoesNotExist:
+        return False
+    instance.generate_thumbnails()
+    return True
+
+def on_thumbnails_source_saved(sender, instance, raw=False, **kwargs):
+    if COOP_CMS_THUMBNAILS_QUEUE and not raw and hasattr(instance, 'generate_thumbnails'):
+        queue_thumbnails(instance)
+post_save.connect(on_thumbnails_source_saved)
+
 
 """
 class NewsletterItem(models.Model):
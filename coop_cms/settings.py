@@ -7,6 +7,21 @@ from django.utils.importlib import import_module
 
 COOP_CMS_NAVTREE_CLASS = getattr(django_settings, 'COOP_CMS_NAVTREE_CLASS', 'basic_cms.NavTree')
 
+#Time in seconds during which the rendered navigation is kept in cache. 0 disables the cache
+COOP_CMS_NAVIGATION_CACHE_TIMEOUT = getattr(django_settings, 'COOP_CMS_NAVIGATION_CACHE_TIMEOUT', 60*60)
+
+#Time in seconds during which the html of the last_articles tag used with 'cached' is kept in cache
+COOP_CMS_ARTICLE_LIST_CACHE_TIMEOUT = getattr(django_settings, 'COOP_CMS_ARTICLE_LIST_CACHE_TIMEOUT', 60*60)
+
+#Time in seconds during which the page of a published article is cached for anonymous users. 0 (default) disables the cache
+COOP_CMS_ARTICLE_PAGE_CACHE_TIMEOUT = getattr(django_settings, 'COOP_CMS_ARTICLE_PAGE_CACHE_TIMEOUT', 0)
+
+#Max number of objects of each type suggested when adding a node to a navigation tree
+COOP_CMS_NAVIGATION_SUGGEST_LIMIT = getattr(django_settings, 'COOP_CMS_NAVIGATION_SUGGEST_LIMIT', 50)
+
+#If True, the thumbnails of the saved objects are generated by the generate_thumbnails command
+COOP_CMS_THUMBNAILS_QUEUE = getattr(django_settings, 'COOP_CMS_THUMBNAILS_QUEUE', False)
+
 
 def get_navigable_content_types():
     ct_choices = []
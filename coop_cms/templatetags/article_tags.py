@@ -5,19 +5,28 @@ from django import template
 
 register = template.Library()
 
-from coop_cms.settings import get_article_class
+from coop_cms.settings import get_article_class, COOP_CMS_ARTICLE_LIST_CACHE_TIMEOUT
+from coop_cms.models import NavNode
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Max, Count
+from django.utils import translation
+import hashlib
 
 
 @register.tag
 def last_articles(parser, token):
     try:
         args = token.split_contents()
+        #optional last argument: cached
+        cached = (args[-1] == 'cached')
+        if cached:
+            args = args[:-1]
         if len(args) == 4:
-            tag_name, number, template, category = token.split_contents()
-            return ArticleListNode(number, template, category)
+            tag_name, number, template, category = args
+            return ArticleListNode(number, template, category, cached)
         elif len(args) == 3:
-            tag_name, number, template = token.split_contents()
-            return ArticleListNode(number, template, None)
+            tag_name, number, template = args
+            return ArticleListNode(number, template, None, cached)
     except ValueError:
         raise template.TemplateSyntaxError('%s tag requires at least 2 arguments' % token.split_contents()[0])
 
@@ -32,26 +41,56 @@ class ArticleListNode(template.Node):
     - A number limit of articles #TODO pagination
     - A template to render each articles
     - An optional ArticleCategory object
+    - An optional 'cached' keyword: the html is cached until an article or the navigation of the articles changes
     """
-    def __init__(self, number, templ, category):
+    def __init__(self, number, templ, category, cached=False):
         self.number = number
         self.templ = templ
+        self.cached = cached
         if category:
             self.category = template.Variable(category)
 
-    def last_articles(self, context):
-        article_list = []
-        all_articles = get_article_class().objects.all().order_by('-created')
+    def get_articles(self, context):
+        all_articles = get_article_class().objects.all()
         if hasattr(self, 'category'):
             category = self.category.resolve(context)
             all_articles = all_articles.filter(category=category)
-        all_articles = all_articles[:self.number]
-        for a in all_articles:
-            if a.navigation_parent == None:
-                article_list.append(a)
-        return article_list
+        return all_articles
+
+    def last_articles(self, context):
+        #the articles which are in navigation are excluded from the last ones in the same query
+        all_articles = self.get_articles(context)
+        last_ids = list(all_articles.order_by('-created').values_list('id', flat=True)[:int(self.number)])
+        in_navigation = NavNode.objects.filter(content_type=get_article_ct()).values('object_id')
+        return get_article_class().objects.filter(id__in=last_ids).exclude(id__in=in_navigation).order_by('-created')
+
+    def get_cache_key(self, context, tmpl):
+        category = self.category.resolve(context) if hasattr(self, 'category') else None
+        articles_state = self.get_articles(context).aggregate(modified=Max('modified'), count=Count('id'))
+        nodes_state = NavNode.objects.filter(content_type=get_article_ct()).aggregate(max_id=Max('id'), count=Count('id'))
+        values = [getattr(category, 'id', category), self.number, tmpl, articles_state['modified'], articles_state['count'],
+            nodes_state['max_id'], nodes_state['count'], translation.get_language()]
+        return 'coop_cms_last_articles_' + hashlib.md5(u'|'.join([unicode(x) for x in values]).encode('utf-8')).hexdigest()
 
     def render(self, context):
         tmpl = resolve(self.templ, context)
+        cache_key = self.get_cache_key(context, tmpl) if self.cached and COOP_CMS_ARTICLE_LIST_CACHE_TIMEOUT else None
+        if cache_key:
+            html = cache.get(cache_key)
+            if html is not None:
+                return html
         t = template.loader.get_template(tmpl)
-        return ''.join([t.render(template.Context({ 'item': item })) for item in self.last_articles(context)])
+        item_context = template.Context()
+        html = []
+        for item in self.last_articles(context):
+            item_context.push()
+            item_context['item'] = item
+            html.append(t.render(item_context))
+            item_context.pop()
+        html = ''.join(html)
+        if cache_key:
+            cache.set(cache_key, html, COOP_CMS_ARTICLE_LIST_CACHE_TIMEOUT)
+        return html
+
+def get_article_ct():
+    return ContentType.objects.get_for_model(get_article_class())
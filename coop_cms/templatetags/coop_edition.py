@@ -8,6 +8,21 @@ from django.utils.translation import ugettext_lazy as _
 from django.core.context_processors import csrf
 from django.utils.safestring import mark_safe
 from coop_cms.widgets import ImageEdit
+from django.conf import settings
+
+_compiled_templates = {}
+
+def get_compiled_template(source):
+    """
+    returns the template compiled from the source string. It is compiled once per process
+    (unless in DEBUG mode so that changes of the included templates are taken into account)
+    """
+    if settings.DEBUG:
+        return template.Template(source)
+    compiled_template = _compiled_templates.get(source, None)
+    if compiled_template is None:
+        compiled_template = _compiled_templates[source] = template.Template(source)
+    return compiled_template
 
 ################################################################################
 class PieceOfHtmlEditNode(DjalohaEditNode):
@@ -46,7 +61,7 @@ class CmsFormMediaNode(template.Node):
     def render(self, context):
         form = context.get('form', None)
         if form:
-            t = template.Template("{{form.media}}")
+            t = get_compiled_template("{{form.media}}")
             return t.render(template.Context({'form': form}))
         else:
             return ""
@@ -100,23 +115,37 @@ CMS_FORM_TEMPLATE = """
     {{inner}} <input type="submit" style="display: none"> </form>
 """
 
+FORM_FIELD_TEMPLATE = """
+                {% include "coop_cms/_form_error.html" with errs=field.errors %}{{field}}
+            """
+
 class SafeWrapper:
 
     def __init__(self, wrapped, logo_size=None):
         self._wrapped = wrapped
         self._logo_size = logo_size
+        #the resolved attributes: a template may use the same one several times
+        self._values = {}
+
+    def _get_logo(self):
+        #the thumbnail url is computed once: each call goes through the sorl backend
+        src = getattr(self._wrapped, 'logo_thumbnail')(False, self._logo_size)
+        if src:
+            return mark_safe(u'<img class="logo" src="{0}">'.format(src.url))
+        return mark_safe(u'')
 
     def __getattr__(self, field):
-        value = getattr(self._wrapped, field)
+        if field.startswith('__'):
+            raise AttributeError(field)
+        if field in self._values:
+            return self._values[field]
         if field=='logo':
-            src = getattr(self._wrapped, 'logo_thumbnail')(False, self._logo_size)
-            if src:
-                value = u'<img class="logo" src="{0}">'.format(src.url)
-            else:
-                value = u''
-        elif callable(value):
-            return value()
-        return mark_safe(value)
+            value = self._get_logo()
+        else:
+            value = getattr(self._wrapped, field)
+            value = value() if callable(value) else mark_safe(value)
+        self._values[field] = value
+        return value
 
 class FormWrapper:
 
@@ -128,10 +157,8 @@ class FormWrapper:
 
     def __getitem__(self, field, logo_size=None):
         if field in self._form.fields.keys():
-            t = template.Template("""
-                    {%% with form.%s.errors as errs %%}{%% include "coop_cms/_form_error.html" %%}{%% endwith %%}{{form.%s}}
-                """ % (field, field))
-            return t.render(template.Context({'form': self._form}))
+            t = get_compiled_template(FORM_FIELD_TEMPLATE)
+            return t.render(template.Context({'field': self._form[field]}))
         else:
             return getattr(self._obj, field)
 
@@ -154,40 +181,38 @@ class CmsEditNode(template.Node):
         #self.log.debug('coop_edition.py:153 - the_object = ' + str(self.var_name))
         the_object = context.get(self.var_name)
 
-        #the context used for rendering the templatetag content
-        inner_context = {}
-        for x in context.dicts:
-            inner_context.update(x)
-
         #the context used for rendering the whole page
         self.post_url = the_object.get_edit_url()
         outer_context = {'post_url': self.post_url}
 
-        inner_context[self.var_name] = the_object  # ???
-
-        safe_context = inner_context.copy()
-        inner_context[self.var_name] = the_object  # ????????
-        inner_value = u""
-
         if form:
-            t = template.Template(CMS_FORM_TEMPLATE)
-            safe_context[self.var_name] = FormWrapper(form, the_object, logo_size=self._logo_size)
+            t = get_compiled_template(CMS_FORM_TEMPLATE)
+            wrapper = FormWrapper(form, the_object, logo_size=self._logo_size)
             outer_context.update(csrf(request))
-            #outer_context['inner'] = self.nodelist_content.render(template.Context(inner_context))
         else:
-            t = template.Template("{{inner|safe}}")
-
-            safe_context[self.var_name] = SafeWrapper(the_object, logo_size=self._logo_size)
+            t = None
+            wrapper = SafeWrapper(the_object, logo_size=self._logo_size)
 
+        #the templatetag content is rendered in a copy of the page context: the tags writing in its
+        #first dict (e.g. djaloha_edit) don't change the rest of the page
+        #variables and text get the wrapper, other nodes get the object itself
+        inner_dict = {}
+        for x in context.dicts:
+            inner_dict.update(x)
+        inner_context = template.Context(inner_dict, autoescape=context.autoescape, current_app=context.current_app)
+        inner_values = []
         for node in self.nodelist_content:
             if isinstance(node, template.VariableNode) or isinstance(node, template.TextNode):
-                c = node.render(template.Context(safe_context))
+                inner_context[self.var_name] = wrapper
             else:
-                #self.log.debug(str(type(node)))
-                c = node.render(template.Context(inner_context))
-                #self.log.debug(u'render = ' + unicode(c))
-            inner_value += c
-        outer_context['inner'] = mark_safe(inner_value) if form else inner_value
+                inner_context[self.var_name] = the_object
+            inner_values.append(node.render(inner_context))
+        inner_value = u"".join(inner_values)
+
+        if not t:
+            #without form, the content is returned as it is
+            return mark_safe(inner_value)
+        outer_context['inner'] = mark_safe(inner_value)
         return t.render(template.Context(outer_context))
 
 
@@ -5,11 +5,13 @@ from django.template.loader import get_template
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
-from coop_cms.models import NavNode
-from coop_cms.settings import get_navTree_class
+from coop_cms.models import navtree_registry
 from django.contrib.contenttypes.models import ContentType
 register = template.Library()
 from django.template import VariableDoesNotExist
+from django.core.cache import cache
+from coop_cms.settings import COOP_CMS_NAVIGATION_CACHE_TIMEOUT
+import hashlib
 
 
 def extract_kwargs(args):
@@ -47,14 +49,38 @@ class NavigationTemplateNode(template.Node):
         if not 'tree' in kwargs:
             kwargs['tree'] = 'default'
 
-        tree, _is_new = get_navTree_class().objects.get_or_create(name=kwargs['tree'])
-        if 'coop_cms_navtrees' in context.dicts[0]:
-            context.dicts[0]['coop_cms_navtrees'].append(tree)
-        else:
-            context.dicts[0]['coop_cms_navtrees'] = [tree]
+        #the trees are not created here anymore: see the create_navtree command
+        tree = navtree_registry.get_tree(kwargs['tree'])
+        if tree:
+            if 'coop_cms_navtrees' in context.dicts[0]:
+                context.dicts[0]['coop_cms_navtrees'].append(tree)
+            else:
+                context.dicts[0]['coop_cms_navtrees'] = [tree]
+        kwargs['tree'] = tree
 
         return kwargs
 
+    def get_cache_key(self, tree, kwargs, *args):
+        #the tree version is part of the key: any change in the tree invalidates the cached html
+        values = [self.__class__.__name__] + [unicode(x) for x in args]
+        for (k, v) in sorted(kwargs.items()):
+            if not isinstance(v, basestring):
+                return None  # a template object can not be used in a key
+            values.append(u'{0}={1}'.format(k, v))
+        digest = hashlib.md5(u'|'.join(values).encode('utf-8')).hexdigest()
+        return 'coop_cms_navigation_{0}_{1}_{2}'.format(tree.id, tree.get_version(), digest)
+
+    def render_cached(self, tree, kwargs, render_fct, *args):
+        """returns the html from cache or call render_fct to generate it"""
+        cache_key = self.get_cache_key(tree, kwargs, *args) if COOP_CMS_NAVIGATION_CACHE_TIMEOUT else None
+        if not cache_key:
+            return render_fct()
+        html = cache.get(cache_key)
+        if html is None:
+            html = render_fct()
+            cache.set(cache_key, html, COOP_CMS_NAVIGATION_CACHE_TIMEOUT)
+        return html
+
 #----------------------------------------------------------
 
 
@@ -65,9 +91,10 @@ class NavigationAsNestedUlNode(NavigationTemplateNode):
 
     def render(self, context):
         kwargs = self.resolve_kwargs(context)
-        tree_name = kwargs.pop('tree', 'default')
-        root_nodes = NavNode.objects.filter(tree__name=tree_name, parent__isnull=True).order_by("ordering")
-        return u''.join([node.as_navigation(**kwargs) for node in root_nodes])
+        tree = kwargs.pop('tree')
+        if not tree:
+            return u''
+        return self.render_cached(tree, kwargs, lambda: tree.load_nodes().as_navigation(**kwargs))
 
 
 @register.tag
@@ -88,12 +115,17 @@ class NavigationBreadcrumbNode(NavigationTemplateNode):
         object = self.object_var.resolve(context)
         ct = ContentType.objects.get_for_model(object.__class__)
         kwargs = self.resolve_kwargs(context)
-        tree_name = kwargs.pop('tree', 'default')
-        nav_nodes = NavNode.objects.filter(tree__name=tree_name, content_type=ct, object_id=object.id)
-        if nav_nodes.exists():
-            kwargs['init'] = nav_nodes[0]
-            return nav_nodes[0].as_breadcrumb(**kwargs)
-        return u''
+        tree = kwargs.pop('tree')
+        if not tree:
+            return u''
+
+        def render_breadcrumb():
+            node = tree.get_node_by_object(ct.id, object.id)
+            if node:
+                node._content_object_cache = object
+                return node.as_breadcrumb(init=node, **kwargs)
+            return u''
+        return self.render_cached(tree, kwargs, render_breadcrumb, ct.id, object.id)
 
 
 @register.tag
@@ -115,11 +147,16 @@ class NavigationChildrenNode(NavigationTemplateNode):
         object = self.object_var.resolve(context)
         ct = ContentType.objects.get_for_model(object.__class__)
         kwargs = self.resolve_kwargs(context)
-        tree_name = kwargs.pop('tree', 'default')
-        nav_nodes = NavNode.objects.filter(tree__name=tree_name, content_type=ct, object_id=object.id)
-        if nav_nodes.exists():
-            return nav_nodes[0].children_as_navigation(**kwargs)
-        return u''
+        tree = kwargs.pop('tree')
+        if not tree:
+            return u''
+
+        def render_children():
+            node = tree.get_node_by_object(ct.id, object.id)
+            if node:
+                return node.children_as_navigation(**kwargs)
+            return u''
+        return self.render_cached(tree, kwargs, render_children, ct.id, object.id)
 
 
 @register.tag
@@ -141,11 +178,16 @@ class NavigationSiblingsNode(NavigationTemplateNode):
         object = self.object_var.resolve(context)
         ct = ContentType.objects.get_for_model(object.__class__)
         kwargs = self.resolve_kwargs(context)
-        tree_name = kwargs.pop('tree', 'default')
-        nav_nodes = NavNode.objects.filter(tree__name=tree_name, content_type=ct, object_id=object.id)
-        if nav_nodes.count() > 0:
-            return nav_nodes[0].siblings_as_navigation(**kwargs)
-        return u''
+        tree = kwargs.pop('tree')
+        if not tree:
+            return u''
+
+        def render_siblings():
+            node = tree.get_node_by_object(ct.id, object.id)
+            if node:
+                return node.siblings_as_navigation(**kwargs)
+            return u''
+        return self.render_cached(tree, kwargs, render_siblings, ct.id, object.id)
 
 
 @register.tag
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.template import Template, Context
-from coop_cms.models import Link, NavNode, NavType, Document, PieceOfHtml # Newsletter, NewsletterItem, NewsletterSending, BaseArticle
+from coop_cms.models import Link, NavNode, NavType, NavLabel, Document, PieceOfHtml, ArticleCategory, PendingThumbnails # Newsletter, NewsletterItem, NewsletterSending, BaseArticle
+from coop_cms.models import navtree_registry, navtype_registry, remove_from_navigation, delete_navigable_objects
+from coop_cms.models import get_object_label, get_object_labels
+from coop_cms.tree_renderer import render_navigation, render_jstree
 import json
+import sys
 from django.core.exceptions import ValidationError
 from coop_cms.settings import get_article_class, get_article_templates, get_navTree_class
 from model_mommy import mommy
@@ -18,6 +22,7 @@ from coop_cms.html2text import html2text
 from coop_cms.utils import make_links_absolute
 from datetime import datetime, timedelta
 from django.core import management
+from django.core.cache import cache
 
 class ArticleTest(TestCase):
     
@@ -70,6 +75,206 @@ class ArticleTest(TestCase):
         response = self.client.get(article.get_absolute_url())
         self.assertEqual(200, response.status_code)
         
+    def test_view_article_page_cache(self):
+        from coop_cms import views
+        article = get_article_class().objects.create(title="test", content="Original", publication=BaseArticle.PUBLISHED)
+        timeout = views.COOP_CMS_ARTICLE_PAGE_CACHE_TIMEOUT
+        views.COOP_CMS_ARTICLE_PAGE_CACHE_TIMEOUT = 60
+        try:
+            self.assertContains(self.client.get(article.get_absolute_url()), "Original")
+            
+            #the content is changed without saving: the cached page is returned
+            get_article_class().objects.filter(id=article.id).update(content="Changed")
+            self.assertContains(self.client.get(article.get_absolute_url()), "Original")
+            
+            #saving the article or changing a tree invalidates the cached page
+            article = get_article_class().objects.get(id=article.id)
+            article.save()
+            self.assertContains(self.client.get(article.get_absolute_url()), "Changed")
+            get_article_class().objects.filter(id=article.id).update(content="Changed again")
+            get_navTree_class().objects.create(name="other")
+            self.assertContains(self.client.get(article.get_absolute_url()), "Changed again")
+            
+            #never cached for editors
+            self._log_as_editor()
+            get_article_class().objects.filter(id=article.id).update(content="Edited")
+            self.assertContains(self.client.get(article.get_absolute_url()), "Edited")
+        finally:
+            views.COOP_CMS_ARTICLE_PAGE_CACHE_TIMEOUT = timeout
+        
+    def test_view_article_not_modified(self):
+        article = get_article_class().objects.create(title="test", publication=BaseArticle.PUBLISHED)
+        response = self.client.get(article.get_absolute_url())
+        self.assertEqual(200, response.status_code)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        
+        response = self.client.get(article.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('', response.content)
+        response = self.client.get(article.get_absolute_url(), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(304, response.status_code)
+        
+        #saving the article, a tree or a piece of html changes the etag
+        article.save()
+        response = self.client.get(article.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+        get_navTree_class().objects.create(name="other")
+        response = self.client.get(article.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+        PieceOfHtml.objects.create(div_id="footer", content="Footer")
+        response = self.client.get(article.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        
+        #no validators for editors
+        self._log_as_editor()
+        response = self.client.get(article.get_absolute_url(), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.has_header('ETag'))
+        
+    def test_articles_category_not_modified(self):
+        category = ArticleCategory.objects.create(name="Catégorie")
+        article = get_article_class().objects.create(title="test", category=category, publication=BaseArticle.PUBLISHED)
+        url = reverse('coop_cms_articles_category', args=[category.slug])
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+        
+        article.title = "Changed"
+        article.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(200, response.status_code)
+        
+    def test_articles_category_article_removed(self):
+        category = ArticleCategory.objects.create(name="Catégorie")
+        other_category = ArticleCategory.objects.create(name="Autre")
+        article_class = get_article_class()
+        article1 = article_class.objects.create(title="test1", category=category, publication=BaseArticle.PUBLISHED)
+        article2 = article_class.objects.create(title="test2", category=category, publication=BaseArticle.PUBLISHED)
+        article3 = article_class.objects.create(title="test3", category=category, publication=BaseArticle.PUBLISHED)
+        url = reverse('coop_cms_articles_category', args=[category.slug])
+        etag = self.client.get(url)['ETag']
+        
+        #the oldest article leaves the category: the most recent modification date of the category doesn't change
+        article1.category = other_category
+        article1.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotContains(response, "test1")
+        etag = response['ETag']
+        
+        #moved without signals
+        article_class.objects.filter(id=article2.id).update(category=other_category)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotContains(response, "test2")
+        etag = response['ETag']
+        
+        article3.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotContains(response, "test3")
+        
+    def test_articles_category_validators_survive_cache_clear(self):
+        category = ArticleCategory.objects.create(name="Catégorie")
+        get_article_class().objects.create(title="test1", category=category, publication=BaseArticle.PUBLISHED)
+        url = reverse('coop_cms_articles_category', args=[category.slug])
+        etag = self.client.get(url)['ETag']
+        cache.clear()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        
+    def test_generate_queued_thumbnails(self):
+        from coop_cms import models
+        article_class = get_article_class()
+        generated = []
+        generate_thumbnails = article_class.generate_thumbnails
+        article_class.generate_thumbnails = lambda obj: generated.append(obj.id)
+        queue = models.COOP_CMS_THUMBNAILS_QUEUE
+        models.COOP_CMS_THUMBNAILS_QUEUE = True
+        try:
+            article1 = article_class.objects.create(title="test1", publication=BaseArticle.PUBLISHED)
+            article2 = article_class.objects.create(title="test2", publication=BaseArticle.PUBLISHED)
+            article1.save()
+            self.assertEqual(2, PendingThumbnails.objects.count())
+            
+            #the objects deleted in the meantime are ignored
+            article2.delete()
+            management.call_command('generate_thumbnails', processes=1, verbosity=0)
+            self.assertEqual([article1.id], generated)
+            self.assertEqual(0, PendingThumbnails.objects.count())
+            
+            management.call_command('generate_thumbnails', processes=1, all=True, verbosity=0)
+            self.assertEqual([article1.id, article1.id], generated)
+            self.assertEqual(0, PendingThumbnails.objects.count())
+        finally:
+            models.COOP_CMS_THUMBNAILS_QUEUE = queue
+            article_class.generate_thumbnails = generate_thumbnails
+        
+    def test_generate_queued_thumbnails_error(self):
+        from coop_cms import models
+        article_class = get_article_class()
+        generate_thumbnails = article_class.generate_thumbnails
+        def failing_generate_thumbnails(obj):
+            if obj.title == "broken":
+                raise IOError("missing file")
+        article_class.generate_thumbnails = failing_generate_thumbnails
+        queue = models.COOP_CMS_THUMBNAILS_QUEUE
+        models.COOP_CMS_THUMBNAILS_QUEUE = True
+        try:
+            article1 = article_class.objects.create(title="broken", publication=BaseArticle.PUBLISHED)
+            article2 = article_class.objects.create(title="test", publication=BaseArticle.PUBLISHED)
+            management.call_command('generate_thumbnails', processes=1, verbosity=0)
+            #the failed object stays in the queue for the next run
+            self.assertEqual([article1.id], [item.object_id for item in PendingThumbnails.objects.all()])
+        finally:
+            models.COOP_CMS_THUMBNAILS_QUEUE = queue
+            article_class.generate_thumbnails = generate_thumbnails
+
+    def test_generate_thumbnails(self):
+        article = get_article_class().objects.create(title="test", publication=BaseArticle.PUBLISHED)
+        self.assertEqual(0, PendingThumbnails.objects.count())
+        article.generate_thumbnails()
+        self.assertTrue(article.logo_thumbnail().url)
+        
+    def test_default_logo_thumbnail_cached(self):
+        from coop_cms import models
+        from django.contrib.staticfiles import finders
+        import tempfile
+        static_filename = tempfile.mktemp(suffix='.png')
+        shutil.copyfile(finders.find(models.DEFAULT_LOGO), static_filename)
+        default_logo = dict(models._default_logo)
+        models._default_logo.update(static_filename=static_filename, mtime=None, thumbnails={})
+        get_thumbnail = models.sorl_thumbnail.backend.get_thumbnail
+        calls = []
+        def counted_get_thumbnail(*args, **kwargs):
+            calls.append(args)
+            return get_thumbnail(*args, **kwargs)
+        models.sorl_thumbnail.backend.get_thumbnail = counted_get_thumbnail
+        try:
+            article1 = get_article_class().objects.create(title="test1", publication=BaseArticle.PUBLISHED)
+            article2 = get_article_class().objects.create(title="test2", publication=BaseArticle.PUBLISHED)
+            thumbnail = article1.logo_thumbnail(logo_size="32x32")
+            self.assertEqual(thumbnail.url, article2.logo_thumbnail(logo_size="32x32").url)
+            self.assertEqual(1, len(calls))
+            article1.logo_thumbnail(logo_size="48x48")
+            self.assertEqual(2, len(calls))
+            
+            #the thumbnails are generated again when the static file changes
+            mtime = os.path.getmtime(static_filename)
+            os.utime(static_filename, (mtime + 10, mtime + 10))
+            article2.logo_thumbnail(logo_size="32x32")
+            self.assertEqual(3, len(calls))
+            article1.logo_thumbnail(logo_size="32x32")
+            self.assertEqual(3, len(calls))
+        finally:
+            models.sorl_thumbnail.backend.get_thumbnail = get_thumbnail
+            models._default_logo.clear()
+            models._default_logo.update(default_logo)
+            os.remove(static_filename)
+        
     def test_404_ok(self):
         response = self.client.get("/jhjhjkahekhj", follow=True)
         self.assertEqual(404, response.status_code)
@@ -363,6 +568,52 @@ class ArticleTest(TestCase):
         self.assertEqual(node.parent, None)
         self.assertEqual(node.tree, tree)
         
+    def test_last_articles(self):
+        Article = get_article_class()
+        articles = [Article.objects.create(title=u"Article {0}".format(i), publication=BaseArticle.PUBLISHED)
+            for i in range(4)]
+        tree = get_navTree_class().objects.create()
+        articles[1].navigation_parent = -tree.id
+        tpl = Template('{% load article_tags %}{% last_articles 3 "coop_cms/article_list_item.html" %}')
+        html = tpl.render(Context({}))
+        for article in articles[2:]:
+            self.assertTrue(html.find(article.title)>=0)
+        for article in articles[:2]:
+            self.assertFalse(html.find(article.title)>=0)
+        
+    def test_last_articles_cached(self):
+        Article = get_article_class()
+        articles = [Article.objects.create(title=u"Article {0}".format(i), publication=BaseArticle.PUBLISHED)
+            for i in range(3)]
+        tpl = Template('{% load article_tags %}{% last_articles 3 "coop_cms/article_list_item.html" cached %}')
+        html = tpl.render(Context({}))
+        with self.assertNumQueries(2):
+            self.assertEqual(html, tpl.render(Context({})))
+        
+        articles[0].title = u"Modified"
+        articles[0].save()
+        self.assertTrue(tpl.render(Context({})).find(u"Modified")>=0)
+        
+        tree = get_navTree_class().objects.create()
+        articles[0].navigation_parent = -tree.id
+        self.assertFalse(tpl.render(Context({})).find(u"Modified")>=0)
+        
+    def test_last_articles_cached_language(self):
+        from django.utils import translation
+        from coop_cms.templatetags.article_tags import ArticleListNode
+        get_article_class().objects.create(title=u"Article", publication=BaseArticle.PUBLISHED)
+        tpl = Template('{% load article_tags %}{% last_articles 3 "coop_cms/article_list_item.html" cached %}')
+        node = [x for x in tpl.nodelist if isinstance(x, ArticleListNode)][0]
+        language = translation.get_language()
+        try:
+            translation.activate('fr')
+            fr_key = node.get_cache_key(Context({}), "coop_cms/article_list_item.html")
+            translation.activate('en')
+            en_key = node.get_cache_key(Context({}), "coop_cms/article_list_item.html")
+        finally:
+            translation.activate(language)
+        self.assertNotEqual(fr_key, en_key)
+
     def test_new_article_navigation_leaf(self):
         initial_data = {'title': "test", 'content': "this is my article content"}
         Article = get_article_class()
@@ -529,6 +780,354 @@ class NavigationTest(TestCase):
         self.assertEqual(nodes[:-2]+nodes[-1:], root_nodes)
         self.assertEqual([1, 2, 3], [n.ordering for n in root_nodes])
         
+    def test_reorder_nodes(self):
+        addrs = ("http://www.google.fr", "http://www.python.org", "http://www.quinode.fr", "http://www.apidev.fr")
+        links = [Link.objects.create(url=a) for a in addrs]
+        nodes = []
+        for i, link in enumerate(links):
+            nodes.append(NavNode.objects.create(tree=self.tree, label=link.url, content_object=link, ordering=i+1, parent=None))
+
+        self._log_as_editor()
+
+        new_order = [nodes[2], nodes[0], nodes[3], nodes[1]]
+        data = {
+            'msg_id': 'reorder_navnodes',
+            'node_ids': ';'.join([str(n.id) for n in new_order]),
+        }
+        response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['status'], 'success')
+
+        root_nodes = list(NavNode.objects.filter(tree=self.tree, parent__isnull=True).order_by("ordering"))
+        self.assertEqual(new_order, root_nodes)
+        self.assertEqual([1, 2, 3, 4], [n.ordering for n in root_nodes])
+
+    def test_reorder_nodes_missing(self):
+        addrs = ("http://www.google.fr", "http://www.python.org", "http://www.quinode.fr")
+        links = [Link.objects.create(url=a) for a in addrs]
+        nodes = []
+        for i, link in enumerate(links):
+            nodes.append(NavNode.objects.create(tree=self.tree, label=link.url, content_object=link, ordering=i+1, parent=None))
+
+        self._log_as_editor()
+
+        data = {
+            'msg_id': 'reorder_navnodes',
+            'node_ids': ';'.join([str(n.id) for n in (nodes[2], nodes[0])]),
+        }
+        response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['status'], 'error')
+
+        root_nodes = list(NavNode.objects.filter(tree=self.tree, parent__isnull=True).order_by("ordering"))
+        self.assertEqual(nodes, root_nodes)
+
+    def _create_nested_nodes(self):
+        addrs = ("http://www.google.fr", "http://www.python.org", "http://www.quinode.fr", "http://www.apidev.fr")
+        links = [Link.objects.create(url=a) for a in addrs]
+        nodes = []
+        parent = None
+        for link in links:
+            parent = NavNode.objects.create(tree=self.tree, label=link.url, content_object=link, ordering=1, parent=parent)
+            nodes.append(parent)
+        return nodes
+
+    def test_node_path(self):
+        nodes = self._create_nested_nodes()
+        self.assertEqual(nodes[0].path, '/')
+        self.assertEqual(nodes[3].path, '/{0}/{1}/{2}/'.format(nodes[0].id, nodes[1].id, nodes[2].id))
+        self.assertEqual(nodes[3].get_depth(), 3)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(nodes[3].get_ancestors(), nodes[:3])
+
+        with self.assertNumQueries(1):
+            progeny = nodes[1].get_progeny()
+        self.assertEqual(progeny, [(nodes[1], 0), (nodes[2], 1), (nodes[3], 2)])
+
+    def test_move_node_path(self):
+        nodes = self._create_nested_nodes()
+        self._log_as_editor()
+
+        data = {
+            'msg_id': 'move_navnode',
+            'node_id': nodes[2].id,
+            'ref_pos': 'after',
+            'ref_id': nodes[0].id,
+        }
+        response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['status'], 'success')
+
+        node = NavNode.objects.get(id=nodes[2].id)
+        self.assertEqual(node.path, '/')
+        child = NavNode.objects.get(id=nodes[3].id)
+        self.assertEqual(child.path, '/{0}/'.format(node.id))
+        self.assertEqual(child.get_ancestors(), [node])
+
+    def test_rebuild_navigation_paths(self):
+        nodes = self._create_nested_nodes()
+        NavNode.objects.update(path='')
+        management.call_command('rebuild_navigation_paths', verbosity=0)
+        for node in nodes:
+            self.assertEqual(NavNode.objects.get(id=node.id).path, node.path)
+
+    def test_node_path_too_long(self):
+        link = Link.objects.create(url='http://www.deep.fr')
+        nodes, parent = [], None
+        for i in range(100):
+            parent = NavNode.objects.create(tree=self.tree, label=str(i), content_object=link, ordering=1, parent=parent)
+            nodes.append(parent)
+        paths = [NavNode.objects.get(id=node.id).path for node in nodes]
+        self.assertTrue(all([len(path) <= 255 for path in paths]))
+        self.assertEqual(paths[-1], '')
+        self.assertEqual([node.path for node in nodes], paths)
+
+        self.assertEqual(nodes[-1].get_ancestors(), nodes[:-1])
+        self.assertEqual(nodes[-1].get_depth(), 99)
+        self.assertEqual([node for (node, level) in nodes[0].get_progeny()], nodes)
+        self.assertRaises(ValidationError, nodes[0].check_new_parent, nodes[-1])
+        self.assertRaises(ValidationError, nodes[50].check_new_parent, nodes[-1])
+
+        NavNode.objects.update(path='')
+        management.call_command('rebuild_navigation_paths', verbosity=0)
+        self.assertEqual([NavNode.objects.get(id=node.id).path for node in nodes], paths)
+
+        #moved to the root: the path of the progeny is known again
+        node = NavNode.objects.get(id=nodes[90].id)
+        node.parent = None
+        node.save()
+        self.assertEqual(node.path, '/')
+        self.assertEqual(NavNode.objects.get(id=nodes[99].id).get_ancestors(), nodes[90:99])
+        self.assertEqual(NavNode.objects.get(id=nodes[99].id).path, u'/' + u''.join([u'{0}/'.format(x.id) for x in nodes[90:99]]))
+        self.assertEqual([(x, level) for (x, level) in node.get_progeny()], [(x, i) for (i, x) in enumerate(nodes[90:])])
+
+        #moved back under the deep node: the path of the progeny is unknown
+        node.parent = NavNode.objects.get(id=nodes[89].id)
+        node.save()
+        self.assertEqual(node.path, '')
+        self.assertEqual(NavNode.objects.get(id=nodes[99].id).path, '')
+        self.assertEqual(NavNode.objects.get(id=nodes[99].id).get_ancestors(), nodes[:99])
+        self.assertEqual([x for (x, level) in nodes[0].get_progeny()], nodes)
+        self.assertEqual([x for (x, level) in node.get_progeny()], nodes[90:])
+
+    def test_check_new_parent_path(self):
+        nodes = self._create_nested_nodes()
+        self.assertRaises(ValidationError, nodes[1].check_new_navigation_parent, nodes[3].id)
+        nodes[3].check_new_navigation_parent(nodes[1].id)
+
+        with self.assertNumQueries(1):
+            self.assertRaises(ValidationError, nodes[0].check_new_navigation_parent, nodes[3].id)
+
+        tree_nodes = self.tree.load_nodes()
+        with self.assertNumQueries(0):
+            self.assertRaises(ValidationError, tree_nodes.get_node(nodes[1].id).check_new_navigation_parent, nodes[3].id)
+            tree_nodes.get_node(nodes[3].id).check_new_navigation_parent(nodes[0].id)
+
+    def test_move_node_under_child(self):
+        nodes = self._create_nested_nodes()
+        self._log_as_editor()
+
+        data = {
+            'msg_id': 'move_navnode',
+            'node_id': nodes[1].id,
+            'parent_id': nodes[3].id,
+            'ref_pos': 'after',
+        }
+        response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(NavNode.objects.get(id=nodes[1].id).parent, nodes[0])
+
+    def _post_batch(self, operations):
+        data = {
+            'msg_id': 'batch_navnodes',
+            'operations': json.dumps(operations),
+        }
+        response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_batch_operations(self):
+        nodes = self._create_nested_nodes()
+        link = Link.objects.create(url="http://www.toto.fr")
+        self._log_as_editor()
+
+        result = self._post_batch([
+            {'msg_id': 'rename_navnode', 'node_id': nodes[3].id, 'name': 'renamed'},
+            {'msg_id': 'move_navnode', 'node_id': nodes[3].id, 'ref_pos': 'after', 'ref_id': nodes[0].id},
+            {'msg_id': 'navnode_in_navigation', 'node_id': nodes[1].id},
+            {'msg_id': 'add_navnode', 'object_type': 'coop_cms.link', 'object_id': link.id, 'parent_id': nodes[3].id},
+            {'msg_id': 'remove_navnode', 'node_ids': nodes[2].id},
+        ])
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual([r['status'] for r in result['results']], ['success'] * 5)
+        self.assertEqual(result['results'][3]['label'], link.url)
+
+        node = NavNode.objects.get(id=nodes[3].id)
+        self.assertEqual(node.label, 'renamed')
+        self.assertEqual(node.parent, None)
+        self.assertEqual(NavNode.objects.get(id=nodes[1].id).in_navigation, False)
+        self.assertEqual(NavNode.objects.get(object_id=link.id, content_type=self.url_ct).parent, node)
+        self.assertEqual(NavNode.objects.filter(id=nodes[2].id).count(), 0)
+
+    def test_batch_operations_cycle(self):
+        nodes = self._create_nested_nodes()
+        self._log_as_editor()
+
+        result = self._post_batch([
+            {'msg_id': 'rename_navnode', 'node_id': nodes[0].id, 'name': 'renamed'},
+            {'msg_id': 'move_navnode', 'node_id': nodes[0].id, 'parent_id': nodes[2].id, 'ref_pos': 'after'},
+        ])
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(NavNode.objects.get(id=nodes[0].id).label, nodes[0].label)
+        self.assertEqual(NavNode.objects.get(id=nodes[0].id).parent, None)
+
+    def test_batch_operations_cycle_jstree_position(self):
+        nodes = self._create_nested_nodes()
+        self._log_as_editor()
+
+        #with the inside position, the reference node is the new parent
+        result = self._post_batch([
+            {'msg_id': 'move_navnode', 'node_id': nodes[0].id, 'ref_pos': 'inside', 'ref_id': nodes[2].id},
+        ])
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(NavNode.objects.get(id=nodes[0].id).parent, None)
+
+    def test_batch_operations_null_parent(self):
+        nodes = self._create_nested_nodes()
+        link = Link.objects.create(url="http://www.toto.fr")
+        self._log_as_editor()
+
+        result = self._post_batch([
+            {'msg_id': 'move_navnode', 'node_id': nodes[2].id, 'parent_id': None, 'ref_pos': 'after', 'ref_id': None},
+            {'msg_id': 'add_navnode', 'object_type': 'coop_cms.link', 'object_id': link.id, 'parent_id': None},
+        ])
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(NavNode.objects.get(id=nodes[2].id).parent, None)
+        self.assertEqual(NavNode.objects.get(object_id=link.id, content_type=self.url_ct).parent, None)
+
+    def test_batch_operations_error(self):
+        nodes = self._create_nested_nodes()
+        self._log_as_editor()
+
+        result = self._post_batch([
+            {'msg_id': 'navnode_in_navigation', 'node_id': nodes[1].id},
+            {'msg_id': 'view_navnode', 'node_id': nodes[1].id},
+            {'msg_id': 'rename_navnode', 'node_id': nodes[0].id, 'name': 'renamed'},
+        ])
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual([r['status'] for r in result['results']], ['success', 'error'])
+
+    def test_batch_operations_missing_argument(self):
+        nodes = self._create_nested_nodes()
+        self._log_as_editor()
+
+        for (operation, name) in (
+            ({'msg_id': 'move_navnode', 'ref_pos': 'after', 'ref_id': nodes[0].id}, 'node_id'),
+            ({'msg_id': 'move_navnode', 'node_id': nodes[3].id, 'ref_id': nodes[0].id}, 'ref_pos'),
+            ({'msg_id': 'rename_navnode', 'node_id': nodes[3].id}, 'name'),
+            ({'msg_id': 'remove_navnode', 'node_id': nodes[3].id}, 'node_ids'),
+            ({'msg_id': 'navnode_in_navigation', 'node_id': None}, 'node_id'),
+            ({'msg_id': 'add_navnode', 'object_type': 'coop_cms.link'}, 'object_id'),
+        ):
+            result = self._post_batch([
+                {'msg_id': 'rename_navnode', 'node_id': nodes[0].id, 'name': 'renamed'},
+                operation,
+            ])
+            self.assertEqual(result['status'], 'error')
+            self.assertEqual([r['status'] for r in result['results']], ['success', 'error'])
+            self.assertEqual(result['results'][1]['message'], u"Missing argument : {0}".format(name))
+
+    def test_batch_operations_remove_list(self):
+        nodes = self._create_nested_nodes()
+        self._log_as_editor()
+
+        #the node_ids can be given as a list or joined like the jstree does
+        result = self._post_batch([
+            {'msg_id': 'remove_navnode', 'node_ids': [nodes[3].id, nodes[2].id]},
+        ])
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(NavNode.objects.filter(id__in=[nodes[2].id, nodes[3].id]).count(), 0)
+
+    def test_node_choices(self):
+        from coop_cms.forms import get_node_choices
+        nodes = self._create_nested_nodes()
+        choices = get_node_choices()
+        self.assertEqual(choices[1:], [(-self.tree.id, self.tree.name)] +
+            [(node.id, u'--'*(i+1)+node.label) for (i, node) in enumerate(nodes)])
+        with self.assertNumQueries(0):
+            self.assertEqual(choices, get_node_choices())
+
+        nodes[2].label = 'renamed'
+        nodes[2].save()
+        self.assertEqual(get_node_choices()[4], (nodes[2].id, u'------renamed'))
+
+    def test_check_moves(self):
+        nodes = self._create_nested_nodes()
+        tree_nodes = self.tree.load_nodes()
+        with self.assertNumQueries(0):
+            #the moves are checked on the tree as it is once they have all been applied
+            tree_nodes.check_moves([(nodes[3].id, None)])
+            tree_nodes.check_moves([(nodes[0].id, nodes[3].id), (nodes[3].id, None)])
+            self.assertRaises(ValidationError, tree_nodes.check_moves, [(nodes[3].id, None), (nodes[0].id, nodes[3].id), (nodes[3].id, nodes[1].id)])
+            self.assertRaises(ValidationError, tree_nodes.check_moves, [(nodes[0].id, nodes[2].id)])
+            self.assertRaises(ValidationError, tree_nodes.check_moves, [(nodes[0].id, 99999)])
+
+    def test_move_node_jstree_positions(self):
+        links = [Link.objects.create(url=a) for a in ("http://www.google.fr", "http://www.python.org",
+            "http://www.toto.fr", "http://www.apidev.fr")]
+        nodes = [NavNode.objects.create(tree=self.tree, label=link.url, content_object=link, ordering=i+1, parent=None)
+            for (i, link) in enumerate(links)]
+        parent = nodes[0]
+        for (i, node) in enumerate(nodes[1:3]):
+            node.parent = parent
+            node.ordering = i+1
+            node.save()
+        self._log_as_editor()
+
+        def move(node, ref_pos, ref_node):
+            #what the jstree sends: with first, inside and last, the reference is the new parent
+            data = {'msg_id': 'move_navnode', 'node_id': node.id, 'ref_pos': ref_pos}
+            if ref_node:
+                data.update({'ref_id': ref_node.id, 'parent_id': ref_node.id})
+            response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        def children(parent):
+            return list(NavNode.objects.filter(parent=parent).order_by('ordering'))
+
+        self.assertEqual(move(nodes[3], 'inside', parent)['status'], 'success')
+        self.assertEqual(children(parent), [nodes[1], nodes[2], nodes[3]])
+        self.assertEqual(children(None), [parent])
+
+        self.assertEqual(move(nodes[3], 'first', parent)['status'], 'success')
+        self.assertEqual(children(parent), [nodes[3], nodes[1], nodes[2]])
+
+        self.assertEqual(move(nodes[3], 'last', parent)['status'], 'success')
+        self.assertEqual(children(parent), [nodes[1], nodes[2], nodes[3]])
+
+        self.assertEqual(move(nodes[2], 'first', parent)['status'], 'success')
+        self.assertEqual(children(parent), [nodes[2], nodes[1], nodes[3]])
+
+        #to the root: the jstree doesn't send any node
+        self.assertEqual(move(nodes[1], 'last', None)['status'], 'success')
+        self.assertEqual(children(None), [parent, nodes[1]])
+        self.assertEqual(children(parent), [nodes[2], nodes[3]])
+
+        self.assertEqual(move(nodes[3], 'first', nodes[1])['status'], 'success')
+        self.assertEqual(children(nodes[1]), [nodes[3]])
+        self.assertEqual(children(parent), [nodes[2]])
+
+        result = move(nodes[2], 'somewhere', parent)
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(children(parent), [nodes[2]])
+
     def test_move_node_to_root(self):
         addrs = ("http://www.google.fr", "http://www.python.org", "http://www.toto.fr")
         links = [Link.objects.create(url=a) for a in addrs]
@@ -790,6 +1389,98 @@ class NavigationTest(TestCase):
         self.assertEqual(result['status'], 'success')
         self.assertEqual(len(result['suggestions']), 2)
         
+    def test_get_suggest_list_get_label_not_in_navigation(self):
+        nt = NavType.objects.get(content_type=self.url_ct)
+        nt.search_field = ''
+        nt.label_rule=NavType.LABEL_USE_GET_LABEL
+        nt.save()
+        
+        addrs = ("http://www.google.fr", "http://www.python.org", "http://www.quinode.fr", "http://www.apidev.fr")
+        links = [Link.objects.create(url=a) for a in addrs]
+        NavNode.objects.create(tree=self.tree, label=links[0].url, content_object=links[0], ordering=1, parent=None)
+        
+        self._log_as_editor()
+        data = {
+            'msg_id': 'get_suggest_list',
+            'term': '.fr'
+        }
+        response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual([s['label'] for s in result['suggestions']], ['www.apidev.fr', 'www.quinode.fr'])
+        
+    def test_navigation_label_index(self):
+        nt = NavType.objects.get(content_type=self.url_ct)
+        self.assertEqual(0, NavLabel.objects.count())
+        
+        link = Link.objects.create(url="http://www.google.fr")
+        self.assertEqual(0, NavLabel.objects.count())
+        
+        nt.search_field = ''
+        nt.label_rule=NavType.LABEL_USE_GET_LABEL
+        nt.save()
+        self.assertEqual(['www.google.fr'], [l.label for l in NavLabel.objects.all()])
+        
+        link.url = "http://www.python.org"
+        link.save()
+        self.assertEqual(['www.python.org'], [l.label for l in NavLabel.objects.all()])
+        
+        link.delete()
+        self.assertEqual(0, NavLabel.objects.count())
+        
+    def test_get_suggest_list_doesnt_build_labels(self):
+        Link.objects.create(url="http://www.google.fr")
+        #changed without the NavType save hook: the labels are not built yet
+        NavType.objects.filter(content_type=self.url_ct).update(search_field='', label_rule=NavType.LABEL_USE_GET_LABEL)
+        navtype_registry.invalidate()
+        self._log_as_editor()
+        data = {'msg_id': 'get_suggest_list', 'term': 'google'}
+        response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(json.loads(response.content)['suggestions'], [])
+        self.assertEqual(0, NavLabel.objects.count())
+
+        management.call_command('rebuild_navigation_labels', verbosity=0)
+        response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual([s['label'] for s in json.loads(response.content)['suggestions']], ['www.google.fr'])
+
+    def test_registry_version_shared_by_processes(self):
+        from django.core.signals import request_started
+        from coop_cms import models
+        #the versions are not shared by the local memory cache
+        versions_in_cache = models.VERSIONS_IN_CACHE
+        models.VERSIONS_IN_CACHE = False
+        try:
+            request_started.send(sender=self.__class__)
+            self.assertEqual(navtree_registry.get_tree(self.tree.name), self.tree)
+
+            #another process adds a tree: only the version in the database is changed
+            get_navTree_class().objects.bulk_create([get_navTree_class()(name="other")])
+            models.Version.objects.filter(name='navtree_registry').update(value='other process')
+            self.assertEqual(navtree_registry.get_tree("other"), None)
+
+            #the version is read again from the database for the next request
+            request_started.send(sender=self.__class__)
+            self.assertEqual(navtree_registry.get_tree("other").name, "other")
+            with self.assertNumQueries(0):
+                navtree_registry.get_tree("other")
+        finally:
+            models.VERSIONS_IN_CACHE = versions_in_cache
+
+    def test_object_label_registry(self):
+        links = [Link.objects.create(url=a) for a in ("http://www.google.fr", "http://www.python.org")]
+        get_object_label(self.url_ct, links[0])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_object_labels(self.url_ct, links), [link.url for link in links])
+        
+        nt = NavType.objects.get(content_type=self.url_ct)
+        nt.label_rule=NavType.LABEL_USE_GET_LABEL
+        nt.save()
+        self.assertEqual(get_object_label(self.url_ct, links[0]), "www.google.fr")
+        
+        nt.delete()
+        self.assertEqual(get_object_label(self.url_ct, links[0]), unicode(links[0]))
+        
     def test_get_suggest_tree_type_all(self):
         nt_link = NavType.objects.get(content_type=self.url_ct)
         
@@ -1009,6 +1700,87 @@ class NavigationTest(TestCase):
         node = nodes[0]
         self.assertEqual(addrs[0], node.content_object.url)
 
+    def test_delete_object_several_nodes(self):
+        link = Link.objects.create(url="http://www.google.fr")
+        other_tree = get_navTree_class().objects.create(name="other")
+        NavNode.objects.create(tree=self.tree, label=link.url, content_object=link, ordering=1, parent=None)
+        NavNode.objects.create(tree=other_tree, label=link.url, content_object=link, ordering=1, parent=None)
+        link.delete()
+        self.assertEqual(0, NavNode.objects.count())
+
+    def test_delete_not_navigable_object(self):
+        link = Link.objects.create(url="http://www.google.fr")
+        NavNode.objects.create(tree=self.tree, label=link.url, content_object=link, ordering=1, parent=None)
+        doc = mommy.make_one(Document)
+        ContentType.objects.get_for_model(Document)
+        navtype_registry.get_items()
+        with self.assertNumQueries(0):
+            remove_from_navigation(Document, doc)
+        self.assertEqual(1, NavNode.objects.count())
+
+    def test_delete_objects_bulk(self):
+        addrs = ("http://www.google.fr", "http://www.python.org", "http://www.quinode.fr")
+        links = [Link.objects.create(url=a) for a in addrs]
+        for i, link in enumerate(links):
+            NavNode.objects.create(tree=self.tree, label=link.url, content_object=link, ordering=i+1, parent=None)
+        version = self.tree.get_version()
+        delete_navigable_objects(Link.objects.filter(url__in=addrs[1:]))
+        self.assertEqual(1, Link.objects.count())
+        nodes = NavNode.objects.all()
+        self.assertEqual(1, nodes.count())
+        self.assertEqual(addrs[0], nodes[0].content_object.url)
+        self.assertNotEqual(version, self.tree.get_version())
+
+    def test_delete_objects_bulk_cascade(self):
+        #the nodes and labels of the objects deleted in cascade are removed
+        article_ct = ContentType.objects.get_for_model(get_article_class())
+        NavType.objects.create(content_type=article_ct, search_field='', label_rule=NavType.LABEL_USE_UNICODE)
+        category = ArticleCategory.objects.create(name="Category")
+        article = get_article_class().objects.create(title="Cascade", category=category, publication=BaseArticle.PUBLISHED)
+        other_article = get_article_class().objects.create(title="Other", publication=BaseArticle.PUBLISHED)
+        for obj in (article, other_article):
+            NavNode.objects.create(tree=self.tree, label=obj.title, content_object=obj, ordering=1, parent=None)
+        self.assertEqual(2, NavLabel.objects.filter(content_type=article_ct).count())
+
+        delete_navigable_objects(ArticleCategory.objects.filter(id=category.id))
+        self.assertEqual(0, get_article_class().objects.filter(id=article.id).count())
+        self.assertEqual([other_article.id], [node.object_id for node in NavNode.objects.filter(content_type=article_ct)])
+        self.assertEqual([other_article.id], [label.object_id for label in NavLabel.objects.filter(content_type=article_ct)])
+
+class NavigationBatchTransactionTest(TransactionTestCase):
+    """the rollback of a batch can't be checked in a TestCase: the transaction functions are disabled"""
+
+    def setUp(self):
+        self.url_ct = ContentType.objects.get(app_label='coop_cms', model='link')
+        NavType.objects.create(content_type=self.url_ct, search_field='url', label_rule=NavType.LABEL_USE_SEARCH_FIELD)
+        self.tree = get_navTree_class().objects.create()
+        self.srv_url = reverse("navigation_tree", args=[self.tree.id])
+        editor = User.objects.create_user('toto', 'toto@toto.fr', 'toto')
+        editor.user_permissions.add(Permission.objects.get(content_type__app_label='coop_cms', codename='change_navtree'))
+        self.client.login(username='toto', password='toto')
+
+    def test_batch_operations_rollback(self):
+        link = Link.objects.create(url="http://www.google.fr")
+        node = NavNode.objects.create(tree=self.tree, label=link.url, content_object=link, ordering=1, parent=None)
+        data = {
+            'msg_id': 'batch_navnodes',
+            'operations': json.dumps([
+                {'msg_id': 'navnode_in_navigation', 'node_id': node.id},
+                {'msg_id': 'rename_navnode', 'node_id': node.id, 'name': 'renamed'},
+                {'msg_id': 'remove_navnode', 'node_ids': node.id + 1000},
+            ]),
+        }
+        response = self.client.post(self.srv_url, data=data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual([r['status'] for r in result['results']], ['success', 'success', 'error'])
+
+        #the operations done before the error are not in the database
+        node = NavNode.objects.get(id=node.id)
+        self.assertEqual(node.in_navigation, True)
+        self.assertEqual(node.label, link.url)
+
 #class NavigationParentTest(TestCase):
 #    
 #    def setUp(self):
@@ -1155,7 +1927,110 @@ class TemplateTagsTest(TestCase):
             
         for n in self.nodes[2:]:
             self.assertFalse(html.find('{0}'.format(n.content_object.url))>=0)
-            
+
+    def test_view_navigation_loaded_tree(self):
+        self._insert_new_node()
+        self.nodes[4].in_navigation = False
+        self.nodes[4].save()
+
+        expected = u''.join([node.as_navigation() for node in self.tree.get_root_nodes()])
+
+        tree_nodes = self.tree.load_nodes()
+        with self.assertNumQueries(0):
+            html = tree_nodes.as_navigation()
+        self.assertEqual(html, expected)
+
+    def _recursive_navigation(self, node, li_template=None, css_class="", ul_template=None, li_args=None):
+        #reference implementation: the nodes rendered recursively
+        if not node.in_navigation:
+            return ""
+        children_li = [self._recursive_navigation(child, li_template) for child in node.get_children(in_navigation=True)]
+        ul_format = node._get_ul_format(ul_template)
+        children_html = ul_format.format(u''.join(children_li)) if children_li else ""
+        args = node._get_li_args(li_args)
+        if args:
+            css_class = " "+args
+        return u'<li{0}>{1}{2}</li>'.format(css_class, node._get_li_content(li_template), children_html)
+
+    def test_tree_renderer_same_output(self):
+        self._insert_new_node()
+        self.nodes[4].in_navigation = False
+        self.nodes[4].save()
+        root_nodes = self.tree.get_root_nodes()
+        options = [
+            {},
+            {'li_template': 'coop_cms/test_li.html', 'css_class': ' class="toto"'},
+            {'ul_template': Template('<ul class="{{node.id}}">{0}</ul>'), 'li_args': Template('id="{{node.id}}"')},
+            {'ul_template': Template('<ul>{0}{0}</ul>')},
+        ]
+        for kwargs in options:
+            expected = u''.join([self._recursive_navigation(node, **kwargs) for node in root_nodes])
+            self.assertEqual(render_navigation(root_nodes, **kwargs), expected)
+            self.assertEqual(u''.join(self.tree.load_nodes().iter_navigation(**kwargs)), expected)
+
+    def test_tree_renderer_deep_tree(self):
+        link = Link.objects.create(url='http://www.deep.fr')
+        parent = None
+        for i in range(sys.getrecursionlimit() + 10):
+            parent = NavNode.objects.create(tree=self.tree, label=str(i), content_object=link, ordering=10, parent=parent)
+        tree_nodes = self.tree.load_nodes()
+        html = tree_nodes.as_navigation()
+        self.assertTrue(html.endswith(u'</li></ul></li></ul></li>'))
+        self.assertEqual(html.count(u'<li>'), len(self.nodes) + sys.getrecursionlimit() + 10)
+        self.assertTrue(render_jstree(tree_nodes.get_root_nodes()).endswith(u'</ul></li>'))
+
+    def test_tree_renderer_jstree(self):
+        self.nodes[1].in_navigation = False
+        self.nodes[1].save()
+        html = render_jstree(self.tree.get_root_nodes())
+        self.assertTrue(html.startswith(u'<li id="node_{0}" rel=in_nav><a href="http://www.google.fr">http://www.google.fr</a><ul></ul></li>'.format(self.nodes[0].id)))
+        self.assertTrue(html.find(u'<li id="node_{0}" rel=out_nav>'.format(self.nodes[1].id))>=0)
+
+    def test_view_navigation_cache(self):
+        tpl = Template('{% load coop_navigation %}{%navigation_as_nested_ul%}')
+        html = tpl.render(Context({}))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(tpl.render(Context({})), html)
+
+        self.nodes[0].label = u'renamed'
+        self.nodes[0].save()
+        html = tpl.render(Context({}))
+        self.assertTrue(html.find(u'>renamed</a>') >= 0)
+
+        self.nodes[1].in_navigation = False
+        self.nodes[1].save()
+        html = tpl.render(Context({}))
+        self.assertFalse(html.find(self.nodes[1].content_object.url) >= 0)
+
+    def test_view_navigation_unknown_tree(self):
+        tpl = Template('{% load coop_navigation %}{% navigation_as_nested_ul tree=oups %}')
+        self.assertEqual(tpl.render(Context({})), u'')
+        self.assertEqual(get_navTree_class().objects.filter(name='oups').count(), 0)
+
+        management.call_command('create_navtree', 'oups', verbosity=0)
+        tree = get_navTree_class().objects.get(name='oups')
+        link = Link.objects.create(url='http://www.oups.fr')
+        NavNode.objects.create(tree=tree, label=link.url, content_object=link, ordering=1, parent=None)
+        self.assertTrue(tpl.render(Context({})).find(link.url) >= 0)
+
+    def test_view_children_cache(self):
+        tpl = Template('{% load coop_navigation %}{% navigation_children obj %}')
+        html = tpl.render(Context({'obj': self.nodes[3].content_object}))
+        self.assertTrue(html.find(self.nodes[4].content_object.url) >= 0)
+
+        self.nodes[4].delete()
+        html = tpl.render(Context({'obj': self.nodes[3].content_object}))
+        self.assertFalse(html.find(self.nodes[4].content_object.url) >= 0)
+        self.assertTrue(html.find(self.nodes[5].content_object.url) >= 0)
+
+    def test_navigation_template_loaded_once(self):
+        from coop_cms.models import get_navigation_template
+        template = get_navigation_template('coop_cms/test_li.html')
+        self.assertTrue(template is get_navigation_template('coop_cms/test_li.html'))
+        cst_tpl = Template('<span>{{node.label}}</span>')
+        self.assertTrue(cst_tpl is get_navigation_template(cst_tpl))
+
     def test_view_navigation_custom_template(self):
         cst_tpl = Template('<span id="{{node.id}}">{{node.label}}</span>')
         tpl = Template('{% load coop_navigation %}{%navigation_as_nested_ul li_template=cst_tpl%}')
@@ -1201,6 +2076,112 @@ class TemplateTagsTest(TestCase):
         for n in (self.nodes[0], self.nodes[1], self.nodes[4]) :
             self.assertFalse(html.find('{0}'.format(n.content_object.url))>=0)
             
+    def test_view_breadcrumb_queries(self):
+        tpl = Template('{% load coop_navigation %}{% navigation_breadcrumb obj %}')
+        obj = self.nodes[5].content_object
+        navtree_registry.get_tree('default')
+        ContentType.objects.get_for_model(Link)
+        #the node and its ancestors: the urls are stored in the nodes
+        with self.assertNumQueries(2):
+            html = tpl.render(Context({'obj': obj}))
+        with self.assertNumQueries(0):
+            self.assertEqual(html, tpl.render(Context({'obj': obj})))
+        
+        self.nodes[3].label = 'renamed'
+        self.nodes[3].save()
+        html = tpl.render(Context({'obj': obj}))
+        self.assertTrue(html.find('>renamed</a>')>=0)
+        
+    def test_node_by_object(self):
+        ct = ContentType.objects.get_for_model(Link)
+        link = self.nodes[3].content_object
+        self.tree.get_node_by_object(ct.id, link.id)
+        with self.assertNumQueries(0):
+            node = self.tree.get_node_by_object(ct.id, link.id)
+        self.assertEqual(node.id, self.nodes[3].id)
+        self.assertEqual(node.parent_id, self.nodes[2].id)
+        self.assertEqual(node.label, self.nodes[3].label)
+        
+        link2 = Link.objects.create(url='http://www.tutu.fr')
+        self.assertEqual(self.tree.get_node_by_object(ct.id, link2.id), None)
+        node2 = NavNode.objects.create(tree=self.tree, label=link2.url, content_object=link2, ordering=1, parent=None)
+        self.assertEqual(self.tree.get_node_by_object(ct.id, link2.id).id, node2.id)
+        
+    def test_view_children_index(self):
+        tpl = Template('{% load coop_navigation %}{% navigation_children obj %}')
+        link = self.nodes[3].content_object
+        ct = ContentType.objects.get_for_model(Link)
+        navtree_registry.get_tree('default')
+        self.tree.get_node_by_object(ct.id, link.id)
+        #only the children are queried
+        with self.assertNumQueries(1):
+            html = tpl.render(Context({'obj': link}))
+        for n in self.nodes[4:]:
+            self.assertTrue(html.find(n.content_object.url)>=0)
+        
+    def test_node_breadcrumb(self):
+        node = NavNode.objects.get(id=self.nodes[5].id)
+        with self.assertNumQueries(1):
+            self.assertEqual(node.get_breadcrumb(), [self.nodes[2], self.nodes[3], self.nodes[5]])
+        
+        node = self.tree.load_nodes().get_node(self.nodes[5].id)
+        with self.assertNumQueries(0):
+            self.assertEqual(node.get_breadcrumb(), [self.nodes[2], self.nodes[3], self.nodes[5]])
+        
+    def test_nodes_with_content_objects(self):
+        nodes = NavNode.objects.with_content_objects().filter(tree=self.tree)
+        with self.assertNumQueries(2):
+            urls = [node.get_absolute_url() for node in nodes]
+        self.assertEqual(sorted(urls), sorted([n.content_object.url for n in self.nodes]))
+        
+    def test_root_nodes_lazy_content_objects(self):
+        #the content objects are only loaded when one of them is accessed
+        with self.assertNumQueries(1):
+            root_nodes = self.tree.get_root_nodes()
+        with self.assertNumQueries(1):
+            urls = [node.content_object.url for node in root_nodes]
+        self.assertEqual(urls, [n.content_object.url for n in self.nodes if n.parent_id is None])
+        
+    def test_node_url(self):
+        node = self.nodes[3]
+        self.assertEqual(node.url, 'http://www.apidev.fr')
+        
+        link = node.content_object
+        link.url = 'http://www.apidev.com'
+        version = self.tree.get_version()
+        link.save()
+        self.assertNotEqual(version, self.tree.get_version())
+        self.assertEqual(NavNode.objects.get(id=node.id).url, 'http://www.apidev.com')
+        
+        tpl = Template('{% load coop_navigation %}{%navigation_as_nested_ul%}')
+        html = tpl.render(Context({}))
+        self.assertTrue(html.find('href="http://www.apidev.com"')>=0)
+        self.assertFalse(html.find('href="http://www.apidev.fr"')>=0)
+        
+    def test_view_navigation_content_objects(self):
+        cst_tpl = Template('<span>{{node.content_object.url}}</span>')
+        tpl = Template('{% load coop_navigation %}{%navigation_as_nested_ul li_template=cst_tpl%}')
+        tpl.render(Context({'cst_tpl': cst_tpl}))
+        #the nodes and then their links when the template needs them
+        with self.assertNumQueries(2):
+            html = tpl.render(Context({'cst_tpl': cst_tpl}))
+        for n in self.nodes:
+            self.assertTrue(html.find(u'<span>{0}</span>'.format(n.content_object.url))>=0)
+        
+    def test_rebuild_navigation_urls(self):
+        NavNode.objects.update(url='')
+        management.call_command('rebuild_navigation_urls', verbosity=0)
+        for n in self.nodes:
+            self.assertEqual(NavNode.objects.get(id=n.id).url, n.content_object.url)
+        
+    def test_admin_nodes_li(self):
+        from django.contrib import admin
+        tree_admin = admin.site._registry[get_navTree_class()]
+        with self.assertNumQueries(1):
+            html = tree_admin.nodes_li(self.tree)
+        for n in self.nodes:
+            self.assertTrue(html.find(n.content_object.url)>=0)
+        
     def test_view_breadcrumb_out_of_navigation(self):
         for n in self.nodes:
             n.in_navigation = False
@@ -1427,6 +2408,74 @@ class CmsEditTagTest(TestCase):
         self.assertContains(response, article.content)
         self.assertContains(response, self.link1.url)
         
+    def test_cms_edit_templates_compiled_once(self):
+        from coop_cms.templatetags import coop_edition
+        self._log_as_editor()
+        article = self._create_article()
+        
+        response = self.client.get(article.get_edit_url(), follow=True)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(coop_edition.CMS_FORM_TEMPLATE in coop_edition._compiled_templates)
+        self.assertTrue(coop_edition.FORM_FIELD_TEMPLATE in coop_edition._compiled_templates)
+        compiled_templates = dict(coop_edition._compiled_templates)
+        
+        response = self.client.get(article.get_edit_url(), follow=True)
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, article.content)
+        self.assertEqual(compiled_templates, coop_edition._compiled_templates)
+        
+    def test_cms_edit_uses_page_context(self):
+        article = self._create_article()
+        tpl = Template(
+            '{% load coop_edition %}{% cms_edit article %}{{article.title}}-{{greeting}}'
+            '{% with article.title as title %}{{title}}{% endwith %}{% end_cms_edit %}'
+        )
+        context = Context({'article': article, 'greeting': 'Hello'})
+        dicts = [dict(x) for x in context.dicts]
+        html = tpl.render(context)
+        self.assertEqual(html, u'test-Hellotest')
+        #the page context is left unchanged
+        self.assertEqual(dicts, [dict(x) for x in context.dicts])
+        self.assertEqual(context['article'], article)
+        
+    def test_cms_edit_doesnt_leak_in_page_context(self):
+        from django.template import Node
+        from coop_cms.templatetags.coop_edition import CmsEditNode
+        
+        class FirstDictNode(Node):
+            #like the coop_piece_of_html tag with djaloha_edit
+            def render(self, context):
+                context.dicts[0]['djaloha_edit'] = True
+                return u''
+        
+        article = self._create_article()
+        tpl = Template('{% load coop_edition %}{% cms_edit article %}{{article.title}}{% end_cms_edit %}')
+        [node for node in tpl.nodelist if isinstance(node, CmsEditNode)][0].nodelist_content.append(FirstDictNode())
+        context = Context({'article': article})
+        self.assertEqual(tpl.render(context), u'test')
+        self.assertFalse('djaloha_edit' in context)
+        
+    def test_cms_edit_logo_thumbnail_once(self):
+        article = self._create_article()
+        article_class = get_article_class()
+        logo_thumbnail = article_class.logo_thumbnail
+        calls = []
+        def counted_logo_thumbnail(obj, temp=False, logo_size=None):
+            calls.append(logo_size)
+            return logo_thumbnail(obj, temp, logo_size)
+        article_class.logo_thumbnail = counted_logo_thumbnail
+        try:
+            tpl = Template(
+                '{% load coop_edition %}{% cms_edit article logo_size=32x32 %}'
+                '{{article.logo}}{{article.title}}{{article.logo}}{{article.title}}{% end_cms_edit %}'
+            )
+            html = tpl.render(Context({'article': article}))
+        finally:
+            article_class.logo_thumbnail = logo_thumbnail
+        self.assertEqual(calls, ['32x32'])
+        self.assertEqual(html.count('<img class="logo"'), 2)
+        self.assertEqual(html.count(article.title), 2)
+        
 class DownloadDocTest(TestCase):
 
     def _clean_files(self):
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of the navigation trees without recursion
+The nodes are walked with an explicit stack and the html is produced as a sequence of chunks
+which can be joined in a single string or sent as they come
+"""
+from string import Formatter
+from django.template import Context
+
+
+def _split_ul_format(ul_format):
+    """
+    returns the parts of the ul format before and after the children
+    or None if the format can't be split (several or complex replacement fields)
+    """
+    before, after, field_found = u'', u'', False
+    for (literal_text, field_name, format_spec, conversion) in Formatter().parse(ul_format):
+        if field_found:
+            if field_name is not None:
+                return None
+            after += literal_text
+        else:
+            before += literal_text
+            if field_name is not None:
+                if field_name not in ('0', '') or format_spec or conversion:
+                    return None
+                field_found = True
+    return (before, after) if field_found else None
+
+
+def iter_navigation(nodes, li_template=None, css_class="", ul_template=None, li_args=None, context=None):
+    """
+    yields the html of the nodes and their children as nested ul and li html tags
+    css_class, ul_template and li_args only apply to the given nodes, not to their children
+    """
+    context = context or Context()
+    #items of the stack are either nodes to render or html to output when going up in the tree
+    stack = [(node, css_class, ul_template, li_args) for node in reversed(list(nodes))]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, basestring):
+            yield item
+            continue
+
+        node, node_css_class, node_ul_template, node_li_args = item
+        if not node.in_navigation:
+            continue
+
+        children = list(node.get_children(in_navigation=True))
+        ul_format = node._get_ul_format(node_ul_template, context)
+        args = node._get_li_args(node_li_args, context)
+        if args:
+            node_css_class = " "+args
+        yield u'<li{0}>{1}'.format(node_css_class, node._get_li_content(li_template, context))
+
+        if children:
+            ul_parts = _split_ul_format(ul_format)
+            if ul_parts:
+                stack.append(ul_parts[1] + u'</li>')
+                stack.extend([(child, "", None, None) for child in reversed(children)])
+                yield ul_parts[0]
+                continue
+            yield ul_format.format(u''.join(iter_navigation(children, li_template, context=context)))
+        yield u'</li>'
+
+
+def render_navigation(nodes, **kwargs):
+    """returns the html of the nodes and their children as nested ul and li html tags"""
+    return u''.join(iter_navigation(nodes, **kwargs))
+
+
+def iter_jstree(nodes):
+    """yields the html of the nodes and their children for the jstree of the navigation editor"""
+    stack = list(reversed(list(nodes)))
+    while stack:
+        item = stack.pop()
+        if isinstance(item, basestring):
+            yield item
+            continue
+
+        li_content = u'<a href="{0}">{1}</a>'.format(item.get_absolute_url(), item.label)
+        yield u'<li id="node_{0}" rel={2}>{1}<ul>'.format(
+            item.id, li_content, "in_nav" if item.in_navigation else "out_nav"
+        )
+        stack.append(u'</ul></li>')
+        stack.extend(reversed(list(item.get_children())))
+
+
+def render_jstree(nodes):
+    """returns the html of the nodes and their children for the jstree of the navigation editor"""
+    return u''.join(iter_jstree(nodes))
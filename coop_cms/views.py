@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from django.http import HttpResponse, Http404, HttpResponseRedirect, HttpResponseForbidden
+from django.http import HttpResponse, Http404, HttpResponseRedirect, HttpResponseForbidden, HttpResponseNotModified
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext, Context, Template
 from django.template.loader import get_template
@@ -11,11 +11,19 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.template.loader import select_template
 from django.db.models.aggregates import Max
+from django.db.models import F
+from django.db import transaction
 from coop_cms import forms
 from django.contrib import messages
 from coop_cms import models
 from django.contrib.auth.decorators import login_required
 from coop_cms.settings import get_article_class, get_article_form, get_navTree_class #, get_newsletter_form
+from coop_cms.settings import COOP_CMS_NAVIGATION_SUGGEST_LIMIT, COOP_CMS_ARTICLE_PAGE_CACHE_TIMEOUT
+from django.core.cache import cache
+from django.utils import translation
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+from django.utils.cache import patch_vary_headers
+import hashlib, time
 from djaloha import utils as djaloha_utils
 from django.core.servers.basehttp import FileWrapper
 import mimetypes, unicodedata
@@ -113,6 +121,59 @@ def set_homepage(request, article_id):
         raise
 
 
+def get_page_validators(request, modified_dates, values=None):
+    """
+    returns the (etag, last_modified) validators of a page showing objects modified at the given dates
+    with the navigation menus and the pieces of html, or None if the page depends on the user
+    or shows pending messages. The optional values are also taken into account by the etag
+    """
+    if (request.method not in ('GET', 'HEAD') or request.user.is_authenticated()
+        or len(messages.get_messages(request))):
+        return None
+    trees = sorted(models.navtree_registry.get_items().values(), key=lambda tree: tree.id)
+    #the versions are the dates of the last changes
+    versions = [models.get_pages_version()] + [tree.get_version() for tree in trees]
+    dates = [x for x in modified_dates if x] + [datetime.strptime(v, '%Y%m%d%H%M%S%f') for v in versions]
+    values = [unicode(x) for x in modified_dates] + versions + [translation.get_language(), request.GET.urlencode()] + (values or [])
+    etag = hashlib.md5(u'|'.join(values).encode('utf-8')).hexdigest()
+    return (etag, max(dates))
+
+
+def is_not_modified(request, validators):
+    """True if the page known by the client has the same validators"""
+    etag, last_modified = validators
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag in parse_etags(if_none_match)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return bool(if_modified_since) and if_modified_since >= int(time.mktime(last_modified.timetuple()))
+
+
+def set_page_validators(response, validators):
+    etag, last_modified = validators
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(time.mktime(last_modified.timetuple()))
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+
+def get_article_page_cache_key(request, article):
+    """
+    returns the key of the cached page of the article or None if it can't be cached:
+    drafts, editors, logged users and requests with arguments or pending messages
+    """
+    if (not COOP_CMS_ARTICLE_PAGE_CACHE_TIMEOUT or request.method != 'GET' or request.GET
+        or article.publication == models.BaseArticle.DRAFT or request.user.is_authenticated()
+        or request.user.has_perm('can_edit_article', article) or len(messages.get_messages(request))):
+        return None
+    #the page shows the menus: the key changes when any tree is modified
+    trees = sorted(models.navtree_registry.get_items().values(), key=lambda tree: tree.id)
+    values = [article.slug, get_article_template(article), translation.get_language(),
+        article.modified.strftime('%Y%m%d%H%M%S%f'), models.get_pages_version()]
+    values += [tree.get_version() for tree in trees]
+    return 'coop_cms_article_page_' + hashlib.md5(u'|'.join(values).encode('utf-8')).hexdigest()
+
+
 def view_article(request, url):
     """view the article"""
     article = get_object_or_404(get_article_class(), slug=url)  # Draft & Published
@@ -122,6 +183,20 @@ def view_article(request, url):
 
     editable = request.user.has_perm('can_edit_article', article)
 
+    validators = None
+    if article.publication != models.BaseArticle.DRAFT and not editable:
+        validators = get_page_validators(request, [article.modified])
+        if validators and is_not_modified(request, validators):
+            return set_page_validators(HttpResponseNotModified(), validators)
+
+    cache_key = get_article_page_cache_key(request, article)
+    if cache_key:
+        cached_page = cache.get(cache_key)
+        if cached_page:
+            content, content_type = cached_page
+            response = HttpResponse(content, content_type=content_type)
+            return set_page_validators(response, validators) if validators else response
+
     context_dict = {
         'editable': editable,
         'edit_mode': False,
@@ -129,11 +204,15 @@ def view_article(request, url):
         'draft': article.publication == models.BaseArticle.DRAFT,
     }
 
-    return render_to_response(
+    response = render_to_response(
         get_article_template(article),
         context_dict,
         context_instance=RequestContext(request)
     )
+    #a page with a csrf token is specific to the user
+    if cache_key and not request.META.get('CSRF_COOKIE_USED'):
+        cache.set(cache_key, (response.content, response['Content-Type']), COOP_CMS_ARTICLE_PAGE_CACHE_TIMEOUT)
+    return set_page_validators(response, validators) if validators else response
 
 
 def coop_bar_aloha_js(request, context):
@@ -580,7 +659,7 @@ def remove_navnode(request, tree):
     """delete a node"""
     #Keep multi node processing even if multi select is not allowed
     response = {}
-    node_ids = request.POST['node_ids'].split(";")
+    node_ids = [x for x in request.POST['node_ids'].split(";") if x]
     for node_id in node_ids:
         models.NavNode.objects.get(tree=tree, id=node_id).delete()
     if len(node_ids) == 1:
@@ -590,6 +669,16 @@ def remove_navnode(request, tree):
     return response
 
 
+#positions of the jstree where the reference node is the new parent
+JSTREE_CHILD_POSITIONS = ('first', 'inside', 'last')
+
+def get_move_parent_id(data):
+    """returns the id of the new parent of a moved node or 0 for the root"""
+    if data.get('ref_pos') in JSTREE_CHILD_POSITIONS:
+        return data.get('ref_id') or data.get('parent_id') or 0
+    return data.get('parent_id') or 0
+
+
 def move_navnode(request, tree):
     """move a node in the tree"""
     response = {}
@@ -599,6 +688,11 @@ def move_navnode(request, tree):
     parent_id = request.POST.get('parent_id', 0)
     ref_id = request.POST.get('ref_id', 0)
 
+    if ref_pos in JSTREE_CHILD_POSITIONS:
+        parent_id, ref_id = get_move_parent_id(request.POST), 0
+    elif ref_pos not in ('before', 'after'):
+        raise ValidationError(_(u"Unknown position '{0}'").format(ref_pos))
+
     node = models.NavNode.objects.get(tree=tree, id=node_id)
 
     if parent_id:
@@ -610,11 +704,17 @@ def move_navnode(request, tree):
 
     if ref_id:
         ref_node = models.NavNode.objects.get(tree=tree, id=ref_id)
+    elif ref_pos == 'first':
+        #before the current first child: appended if there is none
+        ref_node = (list(sibling_nodes.exclude(id=node.id).order_by('ordering')[:1]) or [None])[0]
+        ref_pos = 'before'
     else:
         ref_node = None
 
+    #The siblings are shifted with one UPDATE statement for each range
     #Update parent if changed
     if parent_node != node.parent:
+        node.check_new_parent(parent_node)
         if node.parent:
             ex_siblings = models.NavNode.objects.filter(tree=tree, parent=node.parent).exclude(id=node.id)
         else:
@@ -623,21 +723,16 @@ def move_navnode(request, tree):
         node.parent = parent_node
 
         #restore exsiblings
-        for n in ex_siblings.filter(ordering__gt=node.ordering):
-            n.ordering -= 1
-            n.save()
+        ex_siblings.filter(ordering__gt=node.ordering).update(ordering=F('ordering') - 1)
 
         #move siblings if inserted
         if ref_node:
             if ref_pos == "before":
-                to_be_moved = sibling_nodes.filter(ordering__gte=ref_node.ordering)
+                sibling_nodes.filter(ordering__gte=ref_node.ordering).update(ordering=F('ordering') + 1)
                 node.ordering = ref_node.ordering
             elif ref_pos == "after":
-                to_be_moved = sibling_nodes.filter(ordering__gt=ref_node.ordering)
+                sibling_nodes.filter(ordering__gt=ref_node.ordering).update(ordering=F('ordering') + 1)
                 node.ordering = ref_node.ordering + 1
-            for n in to_be_moved:
-                n.ordering += 1
-                n.save()
 
         else:
             #add at the end
@@ -650,31 +745,23 @@ def move_navnode(request, tree):
         if ref_node:
             if ref_node.ordering > node.ordering:
                 #move forward
-                to_be_moved = sibling_nodes.filter(ordering__lt=ref_node.ordering, ordering__gt=node.ordering)
-                for next_sibling_node in to_be_moved:
-                    next_sibling_node.ordering -= 1
-                    next_sibling_node.save()
-
                 if ref_pos == "before":
+                    to_be_moved = sibling_nodes.filter(ordering__lt=ref_node.ordering, ordering__gt=node.ordering)
                     node.ordering = ref_node.ordering - 1
                 elif ref_pos == "after":
+                    to_be_moved = sibling_nodes.filter(ordering__lte=ref_node.ordering, ordering__gt=node.ordering)
                     node.ordering = ref_node.ordering
-                    ref_node.ordering -= 1
-                    ref_node.save()
+                to_be_moved.update(ordering=F('ordering') - 1)
 
             elif ref_node.ordering < node.ordering:
                 #move backward
-                to_be_moved = sibling_nodes.filter(ordering__gt=ref_node.ordering, ordering__lt=node.ordering)
-                for next_sibling_node in to_be_moved:
-                    next_sibling_node.ordering += 1
-                    next_sibling_node.save()
-
                 if ref_pos == "before":
+                    to_be_moved = sibling_nodes.filter(ordering__gte=ref_node.ordering, ordering__lt=node.ordering)
                     node.ordering = ref_node.ordering
-                    ref_node.ordering += 1
-                    ref_node.save()
                 elif ref_pos == "after":
+                    to_be_moved = sibling_nodes.filter(ordering__gt=ref_node.ordering, ordering__lt=node.ordering)
                     node.ordering = ref_node.ordering + 1
+                to_be_moved.update(ordering=F('ordering') + 1)
 
         else:
             max_ordering = sibling_nodes.aggregate(max_ordering=Max('ordering'))['max_ordering'] or 0
@@ -686,6 +773,28 @@ def move_navnode(request, tree):
     return response
 
 
+def reorder_navnodes(request, tree):
+    """set the ordering of all the children of a node at once"""
+    response = {}
+
+    parent_id = request.POST.get('parent_id', 0)
+    node_ids = [int(x) for x in request.POST['node_ids'].split(";") if x]
+
+    if parent_id:
+        sibling_nodes = models.NavNode.objects.filter(tree=tree, parent__id=parent_id)
+    else:
+        sibling_nodes = models.NavNode.objects.filter(tree=tree, parent__isnull=True)
+
+    if len(set(node_ids)) != len(node_ids) or set(node_ids) != set(sibling_nodes.values_list('id', flat=True)):
+        raise ValidationError(_(u"The new ordering must contain every child of the node once"))
+
+    models.set_navnodes_ordering(node_ids)
+    models.update_navtree_version(tree.id)
+
+    response['message'] = _(u"The nodes have been reordered.")
+    return response
+
+
 def add_navnode(request, tree):
     """Add a new node"""
     response = {}
@@ -735,26 +844,30 @@ def get_suggest_list(request, tree):
 
     for nt in nav_types:
         ct = nt.content_type
+        #Suggest only objects which are not in navigation yet
+        already_in_navigation = models.NavNode.objects.filter(tree=tree, content_type=ct).values('object_id')
         if nt.label_rule == models.NavType.LABEL_USE_SEARCH_FIELD:
             #Get the name of the default field for the current type (eg: Page->title, Url->url ...)
             lookup = {nt.search_field + '__icontains': term}
-            objects = ct.model_class().objects.filter(**lookup)
-        elif nt.label_rule == models.NavType.LABEL_USE_GET_LABEL:
-            objects = [obj for obj in ct.model_class().objects.all() if term.lower() in obj.get_label().lower()]
+            objects = ct.model_class().objects.filter(**lookup).exclude(id__in=already_in_navigation)
+            objects = list(objects.order_by(nt.search_field)[:COOP_CMS_NAVIGATION_SUGGEST_LIMIT])
+            labels = zip([obj.id for obj in objects], models.get_object_labels(ct, objects))
         else:
-            objects = [obj for obj in ct.model_class().objects.all() if term.lower() in unicode(obj).lower()]
+            #Search in the label index rather than computing the label of every object
+            #the index is built when the NavType is saved or by the rebuild_navigation_labels command
+            nav_labels = models.NavLabel.objects.filter(content_type=ct, label__icontains=term)
+            nav_labels = nav_labels.exclude(object_id__in=already_in_navigation)
+            nav_labels = nav_labels.order_by('label')[:COOP_CMS_NAVIGATION_SUGGEST_LIMIT]
+            labels = [(nav_label.object_id, nav_label.label) for nav_label in nav_labels]
 
-        already_in_navigation = [node.object_id for node in models.NavNode.objects.filter(tree=tree, content_type=ct)]
         #Get suggestions as a list of {label: object.get_label() or unicode if no get_label, 'value':<object.id>}
-        for object in objects:
-            if object.id not in already_in_navigation:
-                #Suggest only articles which are not in navigation yet
-                suggestions.append({
-                    'label': models.get_object_label(ct, object),
-                    'value': object.id,
-                    'category': ct.model_class()._meta.verbose_name.capitalize(),
-                    'type': ct.app_label + u'.' + ct.model,
-                })
+        for (object_id, label) in labels:
+            suggestions.append({
+                'label': label,
+                'value': object_id,
+                'category': ct.model_class()._meta.verbose_name.capitalize(),
+                'type': ct.app_label + u'.' + ct.model,
+            })
 
     response['suggestions'] = suggestions
     return response
@@ -778,6 +891,84 @@ def navnode_in_navigation(request, tree):
     return response
 
 
+class NavEditionRequest(object):
+    """the request given to the handler of an operation of a batch"""
+
+    def __init__(self, request, data):
+        self.user = request.user
+        self.method = request.method
+        #a null value is a missing argument, as in the requests of the jstree: e.g. parent_id null is the root
+        #a list of ids is joined like the node_ids sent by the jstree
+        self.POST = dict([(key, u';'.join([unicode(x) for x in value]) if isinstance(value, list) else unicode(value))
+            for (key, value) in data.items() if value is not None])
+
+
+#arguments required by the operations of a batch
+BATCH_OPERATIONS_ARGUMENTS = {
+    'add_navnode': ('object_type', 'object_id'),
+    'move_navnode': ('node_id', 'ref_pos'),
+    'rename_navnode': ('node_id', 'name'),
+    'remove_navnode': ('node_ids',),
+    'navnode_in_navigation': ('node_id',),
+}
+
+def check_batch_operation(operation):
+    """raise a ValidationError if the operation is not supported or if a required argument is missing"""
+    msg_id = operation.get('msg_id')
+    if msg_id not in BATCH_OPERATIONS_ARGUMENTS:
+        raise ValidationError(_(u"Unsupported message : {0}").format(msg_id))
+    for name in BATCH_OPERATIONS_ARGUMENTS[msg_id]:
+        if operation.get(name) in (None, u'', []):
+            raise ValidationError(_(u"Missing argument : {0}").format(name))
+
+
+def get_nav_error_message(ex):
+    if isinstance(ex, KeyError):
+        return u"Unsupported message : %s" % ex
+    elif isinstance(ex, PermissionDenied):
+        return u"You are not allowed to add a node"
+    elif isinstance(ex, ValidationError):
+        return u' - '.join(ex.messages)
+    return u"An error occured : %s" % ex
+
+
+def batch_navnodes(request, tree):
+    """apply a list of add, move, rename, remove and toggle operations at once"""
+    response = {}
+    operations = json.loads(request.POST['operations'])
+
+    handlers = {}
+    for fct in (add_navnode, move_navnode, rename_navnode, remove_navnode, navnode_in_navigation):
+        handlers[fct.__name__] = fct
+
+    #the moves are checked together before changing anything
+    #an operation without its arguments fails with its own error when it is applied
+    moves = [(int(op['node_id']), int(get_move_parent_id(op)) or None)
+        for op in operations if op.get('msg_id') == 'move_navnode' and op.get('node_id') is not None]
+    if moves:
+        tree.load_nodes().check_moves(moves)
+
+    results = []
+    for (index, operation) in enumerate(operations):
+        try:
+            check_batch_operation(operation)
+            result = handlers[operation['msg_id']](NavEditionRequest(request, operation), tree)
+            result['status'] = 'success'
+            results.append(result)
+        except Exception, ex:
+            #all or nothing: cancel the operations already done
+            transaction.rollback()
+            results.append({'status': 'error', 'message': get_nav_error_message(ex)})
+            response['status'] = 'error'
+            response['message'] = _(u"The operation {0} has failed. Nothing has been changed.").format(index + 1)
+            break
+    else:
+        response['message'] = _(u"{0} operations have been done.").format(len(results))
+
+    response['results'] = results
+    return response
+
+
 @login_required
 def process_nav_edition(request, tree_id):
     """This handle ajax request sent by the tree component"""
@@ -794,27 +985,22 @@ def process_nav_edition(request, tree_id):
             #create a map between message name and handler
             #use the function name as message id
             for fct in (view_navnode, rename_navnode, remove_navnode, move_navnode,
-                add_navnode, get_suggest_list, navnode_in_navigation):
+                add_navnode, get_suggest_list, navnode_in_navigation, reorder_navnodes, batch_navnodes):
                 supported_msg[fct.__name__] = fct
 
             #Call the handler corresponding to the requested message
-            response = supported_msg[request.POST['msg_id']](request, tree)
+            #changes are saved only if the handler succeeds
+            with transaction.commit_on_success():
+                response = supported_msg[request.POST['msg_id']](request, tree)
 
             #If no exception raise: Success
-            response['status'] = 'success'
+            response.setdefault('status', 'success')
             response.setdefault('message', 'Ok')  # if no message defined in response, add something
 
-        except KeyError, msg:
-            response = {'status': 'error', 'message': u"Unsupported message : %s" % msg}
-        except PermissionDenied:
-            response = {'status': 'error', 'message': u"You are not allowed to add a node"}
-        except ValidationError, ex:
-            response = {'status': 'error', 'message': u' - '.join(ex.messages)}
         except Exception, msg:
-            print msg
-            response = {'status': 'error', 'message': u"An error occured : %s" % msg}
-        # except:
-        #     response = {'status': 'error', 'message': u"An error occured"}
+            if not isinstance(msg, (KeyError, PermissionDenied, ValidationError)):
+                print msg
+            response = {'status': 'error', 'message': get_nav_error_message(msg)}
 
         #return the result as json object
         return HttpResponse(json.dumps(response), mimetype='application/json')
@@ -966,9 +1152,21 @@ def process_nav_edition(request, tree_id):
 def articles_category(request, slug):
     category = get_object_or_404(models.ArticleCategory, slug=slug)
     articles = get_article_class().objects.filter(category=category)
-    return render_to_response(
+
+    #the category changes are taken into account by the pages version
+    #the articles removed from the category are taken into account by the articles version and the ids
+    articles_modified = list(articles.values_list('id', 'modified'))
+    modified_dates = [max([modified for (id, modified) in articles_modified]) if articles_modified else None]
+    modified_dates.append(datetime.strptime(models.get_articles_version(), '%Y%m%d%H%M%S%f'))
+    values = [u'{0}:{1}'.format(id, modified) for (id, modified) in sorted(articles_modified)]
+    validators = get_page_validators(request, modified_dates, values)
+    if validators and is_not_modified(request, validators):
+        return set_page_validators(HttpResponseNotModified(), validators)
+
+    response = render_to_response(
         'coop_cms/articles_category.html',
         {'category': category, 'articles':articles },
         context_instance=RequestContext(request)
     )
+    return set_page_validators(response, validators) if validators else response
 